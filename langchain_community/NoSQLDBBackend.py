@@ -0,0 +1,748 @@
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from borneo import (NoSQLHandle, NoSQLHandleConfig,
+                    PutRequest, QueryRequest, DeleteRequest, TableRequest, GetRequest, PutOption, GetTableRequest,
+                    TableNotFoundException, TableLimits, TimeToLive,
+                    PrepareRequest, WriteMultipleRequest, MultiDeleteRequest, IllegalArgumentException, FieldRange)
+from borneo.iam import SignatureProvider
+from NoSQLDBMetrics import NoSQLDBMetrics, metrics as default_metrics
+
+# import the time module
+import time
+import atexit
+import itertools
+import json
+import sqlite3
+import threading
+import weakref
+
+
+# Storage modes
+#  document: one row per session, all the messages in the items JSON array (read-modify-write on append)
+#  message : one row per message, primary key (id, seq) - append only writes the new messages
+DOCUMENT_STORAGE = "document"
+MESSAGE_STORAGE = "message"
+
+# WriteMultipleRequest accepts at most 50 operations
+WRITE_MULTIPLE_MAX_OPERATIONS = 50
+
+# tables known to exist per handle, checked again after TABLE_CHECK_TTL seconds
+TABLE_CHECK_TTL = 3600
+
+# match_version of put_document when the put is not conditional
+UNCONDITIONAL = object()
+
+
+def _create_handle(region, compartment_id, auth_type, auth_profile, auth_file_location) -> NoSQLHandle:
+    """Build the signature provider, the config and the handle to the Oracle NoSQL Cloud Service"""
+    if auth_type == "API_KEY":
+       provider = SignatureProvider(config_file=auth_file_location, profile_name=auth_profile);
+    elif auth_type == "INSTANCE_PRINCIPAL":
+       provider = SignatureProvider.create_with_instance_principal();
+    elif auth_type == "RESOURCE_PRINCIPAL":
+       provider = SignatureProvider.create_with_resource_principal();
+    else:
+       raise IllegalArgumentException('Unknown auth_type: ' + str(auth_type))
+    config = NoSQLHandleConfig(region, provider).set_logger(None)
+    config.set_default_compartment(compartment_id)
+    return NoSQLHandle(config)
+
+
+class NoSQLHandleRegistry:
+    """Process-wide pool of NoSQLHandle shared by the histories and the threads.
+
+    A handle is created once per (region, compartment, auth_type, profile, config file) and keeps its
+    HTTP connection pool and signed token cache between sessions. acquire/release count the users,
+    a handle that is no longer used stays open for the next history until shutdown.
+    """
+    def __init__(self):
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, region, compartment_id, auth_type="API_KEY", auth_profile="DEFAULT",
+                auth_file_location="~/.oci/config"):
+        """Return (key, handle), creating the handle on first use"""
+        key = (region, compartment_id, auth_type, auth_profile, auth_file_location)
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is None:
+                print("Connecting to the Oracle NoSQL Cloud Service: " + str(region))
+                entry = [_create_handle(region, compartment_id, auth_type, auth_profile, auth_file_location), 0]
+                self._handles[key] = entry
+            entry[1] += 1
+            return key, entry[0]
+
+    def release(self, key) -> None:
+        """Give back a handle obtained with acquire"""
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None and entry[1] > 0:
+                entry[1] -= 1
+
+    def references(self, key) -> int:
+        """Number of users of the handle"""
+        with self._lock:
+            entry = self._handles.get(key)
+            return 0 if entry is None else entry[1]
+
+    def shutdown(self, force: bool = False) -> None:
+        """Close the handles no longer used, or all of them with force"""
+        with self._lock:
+            for key, (handle, references) in list(self._handles.items()):
+                if references == 0 or force:
+                    print("Close the connection to the Oracle NoSQL Cloud Service")
+                    handle.close()
+                    del self._handles[key]
+
+
+handle_registry = NoSQLHandleRegistry()
+atexit.register(handle_registry.shutdown, True)
+
+
+def shutdown_handles(force: bool = False) -> None:
+    """Close the shared handles, see NoSQLHandleRegistry.shutdown"""
+    handle_registry.shutdown(force)
+
+
+class ChatHistoryBackend(ABC):
+    """Storage operations used by NoSQLDBChatMessageHistory.
+
+    Document mode works on one row per session holding the items, message mode on rows (id, seq, message).
+    Versions are opaque to the history, None meaning that the row does not exist. ttl is in hours, None keeps
+    the expiration of an existing row (a new row then never expires) - the puts do not reset it.
+    Every operation is recorded in metrics under the same names whatever the backend.
+    clock returns the current time in seconds of the expirations, time.time unless the backend replaces it.
+    """
+    handle = None
+    max_batch = WRITE_MULTIPLE_MAX_OPERATIONS
+    clock = staticmethod(time.time)
+
+    def __init__(self, metrics: Optional[NoSQLDBMetrics] = None):
+        self.metrics = metrics if metrics is not None else default_metrics
+
+    @abstractmethod
+    def ensure_table(self, table: str, storage_mode: str, limits: Tuple[int, int, int]) -> None:
+        """Create the table of the storage mode if it does not exist"""
+
+    @abstractmethod
+    def get_document(self, table: str, session_id: str) -> Tuple[Any, Any]:
+        """Return (items, version) of the session row, (None, None) when absent"""
+
+    @abstractmethod
+    def get_document_tail(self, table: str, session_id: str, count: int) -> Any:
+        """Return the last count items of the session row (the items as is if they are encoded), None when absent"""
+
+    @abstractmethod
+    def put_document(self, table: str, session_id: str, items: Any, match_version=UNCONDITIONAL,
+                     ttl: Optional[int] = None, messages: int = 0) -> Any:
+        """Write the session row, only if it still has match_version when given (None: only if absent).
+        Return the new version, None when the condition failed"""
+
+    @abstractmethod
+    def delete_document(self, table: str, session_id: str) -> None:
+        """Delete the session row"""
+
+    @abstractmethod
+    def delete_all(self, table: str) -> None:
+        """Delete all the rows of the table"""
+
+    @abstractmethod
+    def scan_rows(self, table: str, session_id: str, reverse: bool = False,
+                  batch_size: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+        """Yield the rows ({seq, message}) of the session in sequence order, batch by batch.
+        The caller can stop early, the next batches are not read"""
+
+    @abstractmethod
+    def first_sequence(self, table: str, session_id: str) -> Optional[int]:
+        """Sequence of the oldest row of the session, None when there is none"""
+
+    @abstractmethod
+    def last_sequence(self, table: str, session_id: str) -> Optional[int]:
+        """Sequence of the newest row of the session, None when there is none"""
+
+    @abstractmethod
+    def put_rows(self, table: str, session_id: str, rows: Sequence[Tuple[int, Any]], ttl: Optional[int] = None,
+                 if_absent: bool = True) -> bool:
+        """Write at most max_batch (seq, message) rows atomically, False when a row exists and if_absent"""
+
+    @abstractmethod
+    def delete_rows(self, table: str, session_id: str, end_seq: Optional[int] = None) -> None:
+        """Delete the rows of the session, only the ones before end_seq when given"""
+
+    @abstractmethod
+    def session_expiration(self, table: str, session_id: str) -> Optional[float]:
+        """Seconds until the oldest row of the session expires, None when there is none or it never expires"""
+
+    @abstractmethod
+    def refresh_ttl(self, table: str, session_id: str, ttl: int) -> None:
+        """Set the ttl (hours) of all the rows of the session, counted from now"""
+
+    def close(self) -> None:
+        """Release the resources of the backend"""
+
+    def _record(self, operation: str, start_time: float, result=None, messages: int = 0, table: str = None) -> None:
+        """Record an operation started at start_time"""
+        self.metrics.record(operation, (time.perf_counter() - start_time) * 1000, result,
+                            messages=messages, table=table)
+
+
+# prepared statements are shared by all the histories using the same handle
+_prepared_statements = weakref.WeakKeyDictionary()
+_prepared_statements_lock = threading.Lock()
+
+_known_tables = weakref.WeakKeyDictionary()
+_known_tables_lock = threading.Lock()
+
+
+class BorneoBackend(ChatHistoryBackend):
+    """Oracle NoSQL Database backend using a borneo NoSQLHandle.
+
+    Args:
+        handle: the NoSQLHandle to use
+        handle_key: Optional key of the handle in handle_registry, released instead of closed by close
+        metrics: Optional NoSQLDBMetrics, the process-wide one by default
+    """
+    def __init__(self, handle: NoSQLHandle, handle_key=None, metrics: Optional[NoSQLDBMetrics] = None):
+        super().__init__(metrics)
+        self.handle = handle
+        self.handle_key = handle_key
+
+    @classmethod
+    def connect(cls, region, compartment_id, auth_type="API_KEY", auth_profile="DEFAULT",
+                auth_file_location="~/.oci/config", shared_handle: bool = True,
+                metrics: Optional[NoSQLDBMetrics] = None) -> "BorneoBackend":
+        """Backend on the shared handle of handle_registry, or on a new handle"""
+        if shared_handle:
+            key, handle = handle_registry.acquire(region, compartment_id, auth_type, auth_profile, auth_file_location)
+            return cls(handle, key, metrics)
+        print("Connecting to the Oracle NoSQL Cloud Service: " + str(region))
+        return cls(_create_handle(region, compartment_id, auth_type, auth_profile, auth_file_location), None, metrics)
+
+    def _call(self, operation: str, method: Callable, request, messages: int = 0, table: str = None):
+        """Call a NoSQLHandle method and record its latency and usage"""
+        start_time = time.perf_counter()
+        result = method(request)
+        self._record(operation, start_time, result, messages, table)
+        return result
+
+    def ensure_table(self, table: str, storage_mode: str, limits: Tuple[int, int, int]) -> None:
+        """Create the table if it does not exist, at most one check per handle and table every TABLE_CHECK_TTL"""
+        with _known_tables_lock:
+            checked_until = _known_tables.get(self.handle, {}).get(table, 0)
+        if checked_until > time.monotonic():
+            return
+        # creating table if not exists - avoid borneo.exception.OperationThrottlingException: Tenant exceeded DDL operation rate limit.
+        try:
+            getTableRequest = GetTableRequest().set_table_name(table)
+            result = self._call("get_table", self.handle.get_table, getTableRequest, table=table)
+        except TableNotFoundException as e:
+            if storage_mode == MESSAGE_STORAGE:
+                statement = ('Create table if not exists {} (id STRING, seq LONG, message JSON, primary key(shard(id), seq))').format(table)
+            else:
+                statement = ('Create table if not exists {} (id STRING, items JSON, primary key(id))').format(table)
+            request = TableRequest().set_statement(statement).set_table_limits(TableLimits(*limits))
+            self._call("table_request", lambda request: self.handle.do_table_request(request, 50000, 3000), request, table=table)
+        with _known_tables_lock:
+            _known_tables.setdefault(self.handle, {})[table] = time.monotonic() + TABLE_CHECK_TTL
+
+    def query(self, statement: str, variables: Dict[str, Any], limit: Optional[int] = None,
+              table: str = None) -> Iterator[List[Dict[str, Any]]]:
+        """Run a prepared query binding the variables, yield the rows of each round trip"""
+        with _prepared_statements_lock:
+            statements = _prepared_statements.setdefault(self.handle, {})
+            prepared = statements.get(statement)
+        if prepared is None:
+            prepared = self._call("prepare", self.handle.prepare, PrepareRequest().set_statement(statement),
+                                  table=table).get_prepared_statement()
+            with _prepared_statements_lock:
+                statements[statement] = prepared
+        # the prepared query is immutable, the copy carries its own variables
+        bound = prepared.copy_statement()
+        for name, value in variables.items():
+            bound.set_variable(name, value)
+        request = QueryRequest().set_prepared_statement(bound)
+        if limit is not None:
+            request.set_limit(limit)
+        while True:
+            result = self._call("query", self.handle.query, request, table=table)
+            yield result.get_results()
+            if request.is_done():
+                break
+
+    def _query_all(self, statement: str, variables: Dict[str, Any], table: str) -> List[Dict[str, Any]]:
+        rows = []
+        for results in self.query(statement, variables, table=table):
+            rows.extend(results)
+        return rows
+
+    # document storage mode - one row per session
+
+    def get_document(self, table: str, session_id: str) -> Tuple[Any, Any]:
+        request = GetRequest().set_key({'id': session_id}).set_table_name(table)
+        result = self._call("get", self.handle.get, request, table=table)
+        if result.get_value() is None:
+          return None, None
+        return result.get_value()['items'], result.get_version()
+
+    def get_document_tail(self, table: str, session_id: str, count: int) -> Any:
+        # an encoded (compressed) session can only be sliced once decoded
+        statement = ('DECLARE $id STRING; $n INTEGER; '
+                     'SELECT CASE WHEN exists $t.items.codec THEN $t.items '
+                     'ELSE [$t.items[size($) - $n :]] END AS items FROM {} $t WHERE $t.id = $id').format(table)
+        rows = self._query_all(statement, {'$id': session_id, '$n': count}, table)
+        return rows[0]['items'] if rows else None
+
+    def put_document(self, table: str, session_id: str, items: Any, match_version=UNCONDITIONAL,
+                     ttl: Optional[int] = None, messages: int = 0) -> Any:
+        request = PutRequest().set_table_name(table)
+        if ttl is not None:
+            request.set_ttl (TimeToLive.of_hours(ttl))
+        if match_version is None:
+            request.set_option(PutOption.IF_ABSENT)
+        elif match_version is not UNCONDITIONAL:
+            request.set_match_version(match_version)
+        request.set_value({"id":session_id , "items":items})
+        result = self._call("put", self.handle.put, request, messages=messages, table=table)
+        return result.get_version()
+
+    def delete_document(self, table: str, session_id: str) -> None:
+        request = DeleteRequest().set_key({'id': session_id}).set_table_name(table)
+        self._call("delete", self.handle.delete, request, table=table)
+
+    def delete_all(self, table: str) -> None:
+        self._query_all('DELETE FROM {}'.format(table), {}, table)
+
+    # message storage mode - one row per message
+
+    def scan_rows(self, table: str, session_id: str, reverse: bool = False,
+                  batch_size: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+        order = 'DESC' if reverse else 'ASC'
+        statement = ('DECLARE $id STRING; SELECT $t.seq, $t.message FROM {} $t WHERE $t.id = $id '
+                     'ORDER BY $t.id {}, $t.seq {}').format(table, order, order)
+        return self.query(statement, {'$id': session_id}, batch_size, table)
+
+    def first_sequence(self, table: str, session_id: str) -> Optional[int]:
+        statement = ('DECLARE $id STRING; SELECT $t.seq FROM {} $t WHERE $t.id = $id ORDER BY $t.id, $t.seq LIMIT 1').format(table)
+        rows = self._query_all(statement, {'$id': session_id}, table)
+        return rows[0]['seq'] if rows else None
+
+    def last_sequence(self, table: str, session_id: str) -> Optional[int]:
+        statement = ('DECLARE $id STRING; SELECT max($t.seq) AS seq FROM {} $t WHERE $t.id = $id').format(table)
+        rows = self._query_all(statement, {'$id': session_id}, table)
+        return rows[0]['seq'] if rows else None
+
+    def put_rows(self, table: str, session_id: str, rows: Sequence[Tuple[int, Any]], ttl: Optional[int] = None,
+                 if_absent: bool = True) -> bool:
+        # all the rows share the shard key, the WriteMultipleRequest is atomic
+        request = WriteMultipleRequest()
+        for seq, message in rows:
+            put = PutRequest().set_table_name(table)
+            if if_absent:
+                put.set_option(PutOption.IF_ABSENT)
+            if ttl is not None:
+                put.set_ttl(TimeToLive.of_hours(ttl))
+            put.set_value({"id": session_id, "seq": seq, "message": message})
+            request.add(put, True)
+        result = self._call("write_multiple", self.handle.write_multiple, request, messages=len(rows), table=table)
+        return result.get_success()
+
+    def delete_rows(self, table: str, session_id: str, end_seq: Optional[int] = None) -> None:
+        request = MultiDeleteRequest().set_key({'id': session_id}).set_table_name(table)
+        if end_seq is not None:
+            request.set_range(FieldRange('seq').set_end(end_seq, False))
+        while True:
+            result = self._call("multi_delete", self.handle.multi_delete, request, table=table)
+            if result.get_continuation_key() is None:
+                break
+            request.set_continuation_key(result.get_continuation_key())
+
+    def session_expiration(self, table: str, session_id: str) -> Optional[float]:
+        statement = ('DECLARE $id STRING; SELECT expiration_time_millis($t) AS expires FROM {} $t '
+                     'WHERE $t.id = $id ORDER BY $t.id, $t.seq LIMIT 1').format(table)
+        rows = self._query_all(statement, {'$id': session_id}, table)
+        # expiration_time_millis is 0 when the row does not expire
+        if not rows or not rows[0]['expires']:
+            return None
+        return rows[0]['expires'] / 1000 - time.time()
+
+    def refresh_ttl(self, table: str, session_id: str, ttl: int) -> None:
+        # a shard key update changes all the rows of the session at once
+        statement = ('DECLARE $id STRING; $ttl INTEGER; '
+                     'UPDATE {} $t SET TTL $ttl HOURS WHERE $t.id = $id').format(table)
+        self._query_all(statement, {'$id': session_id, '$ttl': ttl}, table)
+
+    def close(self) -> None:
+        """Close the handle, or give it back to the handle_registry"""
+        if self.handle is None:
+           return
+        if self.handle_key is not None:
+           handle_registry.release(self.handle_key)
+        else:
+           print("Close the connection to the Oracle NoSQL Cloud Service")
+           self.handle.close()
+        self.handle = None
+
+
+# Local stand-in backends - no network nor credentials, for tests and benchmarks
+
+class _Usage:
+    """Read/write KB of a stand-in operation, reported like a borneo result"""
+    def __init__(self, read_bytes: int = 0, write_bytes: int = 0):
+        self._read_kb = read_bytes / 1024
+        self._write_kb = write_bytes / 1024
+
+    def get_read_kb(self):
+        return self._read_kb
+
+    def get_write_kb(self):
+        return self._write_kb
+
+
+class _StandInBackend(ChatHistoryBackend):
+    """Common part of the local backends: latency injection, TTL clock and JSON (de)serialization
+
+    Args:
+        latency: seconds added to every round trip, or a function of the operation name returning them
+        clock: function returning the current time in seconds, used for the TTL (time.time by default)
+        metrics: Optional NoSQLDBMetrics, the process-wide one by default
+    """
+    def __init__(self, latency: Union[float, Callable[[str], float]] = 0.0, clock: Callable[[], float] = time.time,
+                 metrics: Optional[NoSQLDBMetrics] = None):
+        super().__init__(metrics)
+        self.latency = latency
+        self.clock = clock
+        self._lock = threading.RLock()
+
+    def _round_trip(self, operation: str) -> None:
+        """Wait for the emulated network latency of the operation"""
+        latency = self.latency(operation) if callable(self.latency) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+
+    def _expires(self, ttl: Optional[int], current: Optional[float] = None) -> Optional[float]:
+        """Expiration of a written row, a put without ttl keeps the current one like borneo"""
+        return current if ttl is None else self.clock() + ttl * 3600
+
+    def _alive(self, expires: Optional[float]) -> bool:
+        return expires is None or expires > self.clock()
+
+    def ensure_table(self, table: str, storage_mode: str, limits: Tuple[int, int, int]) -> None:
+        start_time = time.perf_counter()
+        self._round_trip("get_table")
+        self._record("get_table", start_time, table=table)
+
+    @abstractmethod
+    def _read_document(self, table: str, session_id: str) -> Optional[Tuple[str, Any]]:
+        """(JSON text, version) of the session row, None when absent or expired"""
+
+    def get_document_tail(self, table: str, session_id: str, count: int) -> Any:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        row = self._read_document(table, session_id)
+        items = None if row is None else json.loads(row[0])
+        if isinstance(items, list):
+            items = items[-count:] if count > 0 else []
+        # the query only returns the tail
+        self._record("query", start_time, _Usage(0 if items is None else len(json.dumps(items))), table=table)
+        return items
+
+
+class InMemoryBackend(_StandInBackend):
+    """Backend keeping the tables in process memory, values are stored as JSON text like on the wire"""
+    def __init__(self, latency: Union[float, Callable[[str], float]] = 0.0, clock: Callable[[], float] = time.time,
+                 metrics: Optional[NoSQLDBMetrics] = None):
+        super().__init__(latency, clock, metrics)
+        self._documents = {}
+        self._rows = {}
+        self._versions = itertools.count(1)
+
+    def _read_document(self, table: str, session_id: str) -> Optional[Tuple[str, int]]:
+        """(JSON text, version) of the session row, None when absent or expired"""
+        with self._lock:
+            row = self._documents.get(table, {}).get(session_id)
+            if row is not None and not self._alive(row[2]):
+                del self._documents[table][session_id]
+                row = None
+        return None if row is None else row[:2]
+
+    def get_document(self, table: str, session_id: str) -> Tuple[Any, Any]:
+        start_time = time.perf_counter()
+        self._round_trip("get")
+        row = self._read_document(table, session_id)
+        self._record("get", start_time, _Usage(0 if row is None else len(row[0])), table=table)
+        return (None, None) if row is None else (json.loads(row[0]), row[1])
+
+    def put_document(self, table: str, session_id: str, items: Any, match_version=UNCONDITIONAL,
+                     ttl: Optional[int] = None, messages: int = 0) -> Any:
+        start_time = time.perf_counter()
+        self._round_trip("put")
+        data = json.dumps(items)
+        with self._lock:
+            documents = self._documents.setdefault(table, {})
+            row = documents.get(session_id)
+            current = row[1] if row is not None and self._alive(row[2]) else None
+            if match_version is not UNCONDITIONAL and match_version != current:
+                version = None
+            else:
+                version = next(self._versions)
+                documents[session_id] = (data, version, self._expires(ttl, row[2] if current is not None else None))
+        self._record("put", start_time, _Usage(0, len(data) if version is not None else 0), messages, table)
+        return version
+
+    def delete_document(self, table: str, session_id: str) -> None:
+        start_time = time.perf_counter()
+        self._round_trip("delete")
+        with self._lock:
+            self._documents.get(table, {}).pop(session_id, None)
+        self._record("delete", start_time, table=table)
+
+    def delete_all(self, table: str) -> None:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        with self._lock:
+            self._documents.pop(table, None)
+            self._rows.pop(table, None)
+        self._record("query", start_time, table=table)
+
+    def _session_rows(self, table: str, session_id: str) -> Dict[int, Tuple[str, Optional[float]]]:
+        """Alive rows of the session, expired ones are purged"""
+        rows = self._rows.setdefault(table, {}).setdefault(session_id, {})
+        for seq in [seq for seq, (data, expires) in rows.items() if not self._alive(expires)]:
+            del rows[seq]
+        return rows
+
+    def scan_rows(self, table: str, session_id: str, reverse: bool = False,
+                  batch_size: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+        with self._lock:
+            rows = sorted(self._session_rows(table, session_id).items(), reverse=reverse)
+        if batch_size is None:
+            batch_size = max(len(rows), 1)
+        for start in range(0, max(len(rows), 1), batch_size):
+            start_time = time.perf_counter()
+            self._round_trip("query")
+            batch = rows[start:start + batch_size]
+            results = [{'seq': seq, 'message': json.loads(data)} for seq, (data, expires) in batch]
+            self._record("query", start_time, _Usage(sum(len(data) for seq, (data, expires) in batch)), table=table)
+            yield results
+
+    def first_sequence(self, table: str, session_id: str) -> Optional[int]:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        with self._lock:
+            rows = self._session_rows(table, session_id)
+            seq = min(rows) if rows else None
+        self._record("query", start_time, table=table)
+        return seq
+
+    def last_sequence(self, table: str, session_id: str) -> Optional[int]:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        with self._lock:
+            rows = self._session_rows(table, session_id)
+            seq = max(rows) if rows else None
+        self._record("query", start_time, table=table)
+        return seq
+
+    def put_rows(self, table: str, session_id: str, rows: Sequence[Tuple[int, Any]], ttl: Optional[int] = None,
+                 if_absent: bool = True) -> bool:
+        start_time = time.perf_counter()
+        self._round_trip("write_multiple")
+        encoded = [(seq, json.dumps(message)) for seq, message in rows]
+        with self._lock:
+            session = self._session_rows(table, session_id)
+            success = not (if_absent and any(seq in session for seq, data in encoded))
+            if success:
+                for seq, data in encoded:
+                    session[seq] = (data, self._expires(ttl, session[seq][1] if seq in session else None))
+        written = sum(len(data) for seq, data in encoded) if success else 0
+        self._record("write_multiple", start_time, _Usage(0, written), len(rows), table)
+        return success
+
+    def delete_rows(self, table: str, session_id: str, end_seq: Optional[int] = None) -> None:
+        start_time = time.perf_counter()
+        self._round_trip("multi_delete")
+        with self._lock:
+            session = self._session_rows(table, session_id)
+            for seq in [seq for seq in session if end_seq is None or seq < end_seq]:
+                del session[seq]
+        self._record("multi_delete", start_time, table=table)
+
+    def session_expiration(self, table: str, session_id: str) -> Optional[float]:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        with self._lock:
+            rows = self._session_rows(table, session_id)
+            expires = rows[min(rows)][1] if rows else None
+        self._record("query", start_time, table=table)
+        return None if expires is None else expires - self.clock()
+
+    def refresh_ttl(self, table: str, session_id: str, ttl: int) -> None:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        with self._lock:
+            session = self._session_rows(table, session_id)
+            expires = self._expires(ttl)
+            for seq, (data, current) in list(session.items()):
+                session[seq] = (data, expires)
+        self._record("query", start_time, table=table)
+
+
+class SQLiteBackend(_StandInBackend):
+    """Backend storing the tables in a SQLite database file (or in memory with ':memory:')
+
+    Args:
+        path: the SQLite database file
+        latency, clock, metrics: see _StandInBackend
+    """
+    def __init__(self, path: str = ":memory:", latency: Union[float, Callable[[str], float]] = 0.0,
+                 clock: Callable[[], float] = time.time, metrics: Optional[NoSQLDBMetrics] = None):
+        super().__init__(latency, clock, metrics)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS documents (tbl TEXT, id TEXT, items TEXT, '
+                                     'version INTEGER, expires REAL, PRIMARY KEY (tbl, id))')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS messages (tbl TEXT, id TEXT, seq INTEGER, '
+                                     'message TEXT, expires REAL, PRIMARY KEY (tbl, id, seq))')
+        last_version = self._connection.execute('SELECT max(version) FROM documents').fetchone()[0]
+        self._versions = itertools.count((last_version or 0) + 1)
+
+    _ALIVE = '(expires IS NULL OR expires > ?)'
+
+    def _read_document(self, table: str, session_id: str) -> Optional[Tuple[str, int]]:
+        with self._lock:
+            return self._connection.execute('SELECT items, version FROM documents WHERE tbl = ? AND id = ? AND ' + self._ALIVE,
+                                            (table, session_id, self.clock())).fetchone()
+
+    def get_document(self, table: str, session_id: str) -> Tuple[Any, Any]:
+        start_time = time.perf_counter()
+        self._round_trip("get")
+        row = self._read_document(table, session_id)
+        self._record("get", start_time, _Usage(0 if row is None else len(row[0])), table=table)
+        return (None, None) if row is None else (json.loads(row[0]), row[1])
+
+    def put_document(self, table: str, session_id: str, items: Any, match_version=UNCONDITIONAL,
+                     ttl: Optional[int] = None, messages: int = 0) -> Any:
+        start_time = time.perf_counter()
+        self._round_trip("put")
+        data = json.dumps(items)
+        with self._lock, self._connection:
+            row = self._connection.execute('SELECT version, expires FROM documents WHERE tbl = ? AND id = ? AND ' + self._ALIVE,
+                                           (table, session_id, self.clock())).fetchone()
+            current = None if row is None else row[0]
+            if match_version is not UNCONDITIONAL and match_version != current:
+                version = None
+            else:
+                version = next(self._versions)
+                self._connection.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)',
+                                         (table, session_id, data, version,
+                                          self._expires(ttl, None if row is None else row[1])))
+        self._record("put", start_time, _Usage(0, len(data) if version is not None else 0), messages, table)
+        return version
+
+    def delete_document(self, table: str, session_id: str) -> None:
+        start_time = time.perf_counter()
+        self._round_trip("delete")
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM documents WHERE tbl = ? AND id = ?', (table, session_id))
+        self._record("delete", start_time, table=table)
+
+    def delete_all(self, table: str) -> None:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM documents WHERE tbl = ?', (table,))
+            self._connection.execute('DELETE FROM messages WHERE tbl = ?', (table,))
+        self._record("query", start_time, table=table)
+
+    def scan_rows(self, table: str, session_id: str, reverse: bool = False,
+                  batch_size: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+        order = 'DESC' if reverse else 'ASC'
+        with self._lock:
+            rows = self._connection.execute('SELECT seq, message FROM messages WHERE tbl = ? AND id = ? AND ' + self._ALIVE +
+                                            ' ORDER BY seq ' + order, (table, session_id, self.clock())).fetchall()
+        if batch_size is None:
+            batch_size = max(len(rows), 1)
+        for start in range(0, max(len(rows), 1), batch_size):
+            start_time = time.perf_counter()
+            self._round_trip("query")
+            batch = rows[start:start + batch_size]
+            results = [{'seq': seq, 'message': json.loads(data)} for seq, data in batch]
+            self._record("query", start_time, _Usage(sum(len(data) for seq, data in batch)), table=table)
+            yield results
+
+    def _sequence(self, aggregate: str, table: str, session_id: str) -> Optional[int]:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        with self._lock:
+            seq = self._connection.execute('SELECT ' + aggregate + '(seq) FROM messages WHERE tbl = ? AND id = ? AND ' + self._ALIVE,
+                                           (table, session_id, self.clock())).fetchone()[0]
+        self._record("query", start_time, table=table)
+        return seq
+
+    def first_sequence(self, table: str, session_id: str) -> Optional[int]:
+        return self._sequence('min', table, session_id)
+
+    def last_sequence(self, table: str, session_id: str) -> Optional[int]:
+        return self._sequence('max', table, session_id)
+
+    def put_rows(self, table: str, session_id: str, rows: Sequence[Tuple[int, Any]], ttl: Optional[int] = None,
+                 if_absent: bool = True) -> bool:
+        start_time = time.perf_counter()
+        self._round_trip("write_multiple")
+        encoded = [(seq, json.dumps(message)) for seq, message in rows]
+        now = self.clock()
+        with self._lock, self._connection:
+            success = True
+            if if_absent:
+                for seq, data in encoded:
+                    if self._connection.execute('SELECT 1 FROM messages WHERE tbl = ? AND id = ? AND seq = ? AND ' + self._ALIVE,
+                                                (table, session_id, seq, now)).fetchone() is not None:
+                        success = False
+                        break
+            if success:
+                rows = []
+                for seq, data in encoded:
+                    current = None
+                    if ttl is None:
+                        row = self._connection.execute('SELECT expires FROM messages WHERE tbl = ? AND id = ? AND seq = ? AND ' +
+                                                       self._ALIVE, (table, session_id, seq, now)).fetchone()
+                        current = None if row is None else row[0]
+                    rows.append((table, session_id, seq, data, self._expires(ttl, current)))
+                self._connection.executemany('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)', rows)
+        written = sum(len(data) for seq, data in encoded) if success else 0
+        self._record("write_multiple", start_time, _Usage(0, written), len(rows), table)
+        return success
+
+    def delete_rows(self, table: str, session_id: str, end_seq: Optional[int] = None) -> None:
+        start_time = time.perf_counter()
+        self._round_trip("multi_delete")
+        with self._lock, self._connection:
+            if end_seq is None:
+                self._connection.execute('DELETE FROM messages WHERE tbl = ? AND id = ?', (table, session_id))
+            else:
+                self._connection.execute('DELETE FROM messages WHERE tbl = ? AND id = ? AND seq < ?', (table, session_id, end_seq))
+        self._record("multi_delete", start_time, table=table)
+
+    def session_expiration(self, table: str, session_id: str) -> Optional[float]:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        now = self.clock()
+        with self._lock:
+            row = self._connection.execute('SELECT expires FROM messages WHERE tbl = ? AND id = ? AND ' + self._ALIVE +
+                                           ' ORDER BY seq LIMIT 1', (table, session_id, now)).fetchone()
+        self._record("query", start_time, table=table)
+        return None if row is None or row[0] is None else row[0] - now
+
+    def refresh_ttl(self, table: str, session_id: str, ttl: int) -> None:
+        start_time = time.perf_counter()
+        self._round_trip("query")
+        now = self.clock()
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE messages SET expires = ? WHERE tbl = ? AND id = ? AND ' + self._ALIVE,
+                                     (self._expires(ttl), table, session_id, now))
+        self._record("query", start_time, table=table)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,356 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.embeddings import Embeddings
+from langchain_core.load import dumps, loads
+from NoSQLDBMetrics import NoSQLDBMetrics, metrics as default_metrics
+from NoSQLDBBackend import DOCUMENT_STORAGE, BorneoBackend, ChatHistoryBackend
+
+# import the time module
+import time
+import hashlib
+import json
+import math
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# embeddings of the prompts missed by lookup, reused by their update - the model calls that fail leave theirs
+# behind, the oldest are dropped beyond this number
+PENDING_EMBEDDINGS_MAX = 1000
+
+
+def prompt_text(prompt: str) -> str:
+    """Text of the prompt - chat models give the serialized messages, turned into one "type: content" line each"""
+    if not prompt.startswith('[{'):
+        return prompt
+    try:
+        messages = json.loads(prompt)
+        lines = []
+        for message in messages:
+            kwargs = message['kwargs']
+            content = kwargs.get('content')
+            lines.append(kwargs.get('type', message['id'][-1]) + ': ' +
+                         (content if isinstance(content, str) else json.dumps(content, sort_keys=True)))
+        return '\n'.join(lines)
+    except (ValueError, KeyError, TypeError, IndexError):
+        return prompt
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Prompt used for the key - surrounding and repeated whitespace do not make a different prompt"""
+    return re.sub(r'[ \t]+', ' ', '\n'.join(line.strip() for line in prompt_text(prompt).splitlines())).strip()
+
+
+def cache_key(prompt: str, llm_string: str) -> str:
+    """Key of a response: hash of the model and sampling parameters (llm_string) and of the normalized prompt"""
+    return hashlib.sha256((llm_string + '\n' + normalize_prompt(prompt)).encode('utf-8')).hexdigest()
+
+
+class _VectorIndex:
+    """Local index of the embeddings of the cached prompts, the least recently added are evicted"""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    def add(self, key: str, llm_string: str, vector: Sequence[float]) -> None:
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        with self._lock:
+            self._entries[key] = (llm_string, [value / norm for value in vector])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._matrix = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def nearest(self, llm_string: str, vector: Sequence[float]) -> Tuple[Optional[str], float]:
+        """Key and cosine similarity of the closest prompt cached for the same llm_string"""
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        vector = [value / norm for value in vector]
+        with self._lock:
+            entries = list(self._entries.items())
+            if numpy is not None and entries:
+                if self._matrix is None:
+                    self._matrix = numpy.array([entry[1] for key, entry in entries])
+                scores = self._matrix @ numpy.array(vector)
+        best_key, best_score = None, -1.0
+        for index, (key, (entry_llm_string, entry_vector)) in enumerate(entries):
+            if entry_llm_string != llm_string:
+                continue
+            if numpy is not None:
+                score = float(scores[index])
+            else:
+                score = sum(a * b for a, b in zip(entry_vector, vector))
+            if score > best_score:
+                best_key, best_score = key, score
+        return best_key, best_score
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class _ByteLRU:
+    """In-process LRU of the responses bounded by their serialized size in bytes"""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            generations, size, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                self._entries.pop(key)
+                self.bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return generations
+
+    def put(self, key: str, generations: RETURN_VAL_TYPE, size: int, expires: Optional[float]) -> int:
+        """Store the response, return the number of evicted responses"""
+        evicted = 0
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            if size > self.max_bytes:
+                return 0
+            self._entries[key] = (generations, size, expires)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                key, (generations, size, expires) = self._entries.popitem(last=False)
+                self.bytes -= size
+                evicted += 1
+        return evicted
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class NoSQLDBCache(BaseCache):
+    """LangChain LLM cache that stores the responses in Oracle NoSQL DB.
+
+    A response is stored in a row (id STRING, items JSON) whose id hashes the model id and sampling parameters
+    (the llm_string given by LangChain) and the normalized prompt. Use it for a model with
+    ChatOCIGenAI(cache=NoSQLDBCache(...)) or for all of them with set_llm_cache.
+
+    Lookups go to the local L1 (when l1_max_bytes is given), then to the table (L2), then to the similarity
+    index. With single_flight, the lookups of a prompt missed by another caller that is still calling the
+    model wait for its update instead of calling the model too. Exact caching fits deterministic requests
+    (temperature 0), the sampling parameters are part of the key.
+
+    Args:
+        region: region to connect
+        table_name: name of the table to use
+        compartment_id: name of the compartment to use
+        ttl: Optional Time-to-live (TTL) in hours of the cached responses
+        ru,wu,storage : default limits for the table
+        shared_handle: reuse the handle of the process-wide handle_registry (default), the same handle as the histories
+        ensure_table: check that the table exists and create it if needed (default)
+        embeddings: Optional Embeddings enabling the similarity lookup - on an exact miss the response of the
+           closest prompt cached for the same model and parameters is returned when its cosine similarity is
+           at least similarity_threshold. The embeddings are kept in a local index of this process.
+        similarity_threshold: minimum cosine similarity of the similarity lookup
+        max_index_entries: number of prompts kept in the local index
+        metrics: Optional NoSQLDBMetrics, the process-wide NoSQLDBMetrics.metrics by default
+        backend: Optional ChatHistoryBackend storing the responses instead of Oracle NoSQL Database
+        l1_max_bytes: Optional size in bytes (serialized responses) of the in-process LRU in front of the table
+        single_flight: make the concurrent lookups of a missed prompt wait for the first caller's update
+        flight_timeout: seconds a lookup waits for the first caller, after which it calls the model itself.
+           A flight whose leader looks the prompt up again (its model call failed) or whose thread ended is
+           taken over at once.
+        auth_type, auth_profile, auth_file_location: SAME AUTH as NoSQLDBChatMessageHistory
+    """
+    def __init__(
+        self,
+        region: Optional[str] = None,
+        table_name: str = "LLMCache",
+        compartment_id: Optional[str] = None,
+        ttl: Optional[int] = None,
+        auth_type: Optional[str] = "API_KEY",
+        auth_profile: Optional[str] = "DEFAULT",
+        auth_file_location: Optional[str] = "~/.oci/config",
+        ru: Optional[str] = 10,
+        wu: Optional[str] = 10,
+        storage: Optional[str] = 1,
+        shared_handle: bool = True,
+        ensure_table: bool = True,
+        embeddings: Optional[Embeddings] = None,
+        similarity_threshold: float = 0.95,
+        max_index_entries: int = 10000,
+        metrics: Optional[NoSQLDBMetrics] = None,
+        backend: Optional[ChatHistoryBackend] = None,
+        l1_max_bytes: Optional[int] = None,
+        single_flight: bool = False,
+        flight_timeout: float = 5.0,
+    ):
+        self.table = table_name
+        self.ttl = ttl
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.metrics = metrics if metrics is not None else default_metrics
+        self._index = _VectorIndex(max_index_entries) if embeddings is not None else None
+        self._l1 = _ByteLRU(l1_max_bytes) if l1_max_bytes is not None else None
+        self.single_flight = single_flight
+        self.flight_timeout = flight_timeout
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._pending_embeddings = OrderedDict()
+        self._pending_lock = threading.Lock()
+
+        self._owns_backend = backend is None
+        if backend is None:
+            backend = BorneoBackend.connect(region, compartment_id, auth_type, auth_profile, auth_file_location,
+                                            shared_handle, self.metrics)
+        self.backend = backend
+        if ensure_table:
+            self.backend.ensure_table(self.table, DOCUMENT_STORAGE, (ru, wu, storage))
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        """Look up the response of the prompt, then of a similar prompt when embeddings are given"""
+        key = cache_key(prompt, llm_string)
+        generations = self._cached(key, llm_string)
+        if generations is not None:
+            return generations
+        if self._index is not None and len(self._index):
+            vector = self._embed(prompt)
+            similar, score = self._index.nearest(llm_string, vector)
+            if similar is not None and score >= self.similarity_threshold:
+                generations = self._get(similar, llm_string)
+                if generations is not None:
+                    self.metrics.increment("llm_cache_similar_hit")
+                    return generations
+                # expired or deleted meanwhile
+                self._index.remove(similar)
+            # the update of the response of the model indexes the prompt with it
+            with self._pending_lock:
+                self._pending_embeddings[key] = vector
+                while len(self._pending_embeddings) > PENDING_EMBEDDINGS_MAX:
+                    self._pending_embeddings.popitem(last=False)
+        if self.single_flight:
+            return self._join_flight(key, llm_string)
+        self.metrics.increment("llm_cache_miss")
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        """Store the response of the prompt"""
+        key = cache_key(prompt, llm_string)
+        items = {"llm_string": llm_string, "generations": [dumps(generation) for generation in return_val]}
+        try:
+            self.backend.put_document(self.table, key, items, ttl=self.ttl, messages=len(return_val))
+            self._put_l1(key, return_val, items)
+        finally:
+            # the waiting lookups read L1, or the table when there is no L1
+            self._end_flight(key)
+        if self._index is not None:
+            with self._pending_lock:
+                vector = self._pending_embeddings.pop(key, None)
+            self._index.add(key, llm_string, vector if vector is not None else self._embed(prompt))
+
+    def clear(self, **kwargs: Any) -> None:
+        """Delete all the cached responses"""
+        self.backend.delete_all(self.table)
+        if self._l1 is not None:
+            self._l1.clear()
+        if self._index is not None:
+            self._index.clear()
+        with self._pending_lock:
+            self._pending_embeddings.clear()
+
+    def close(self) -> None:
+        """Release the handle, a backend given to the constructor is left open"""
+        if self._owns_backend and self.backend is not None:
+            self.backend.close()
+        self.backend = None
+
+    def _cached(self, key: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        """Response of the key from L1 or the table, counting the hits"""
+        if self._l1 is not None:
+            generations = self._l1.get(key)
+            if generations is not None:
+                self.metrics.increment("llm_cache_l1_hit")
+                return generations
+        generations = self._get(key, llm_string)
+        if generations is not None:
+            self.metrics.increment("llm_cache_hit")
+        return generations
+
+    def _get(self, key: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        items, version = self.backend.get_document(self.table, key)
+        if items is None or items.get("llm_string") != llm_string:
+            return None
+        # the cache table is written by this class only
+        generations = [loads(generation, allowed_objects="all") for generation in items["generations"]]
+        self._put_l1(key, generations, items)
+        return generations
+
+    def _put_l1(self, key: str, generations: RETURN_VAL_TYPE, items: Dict[str, Any]) -> None:
+        if self._l1 is None:
+            return
+        # L1 entries do not outlive the row
+        expires = None if self.ttl is None else time.monotonic() + self.ttl * 3600
+        evicted = self._l1.put(key, generations, sum(len(generation) for generation in items["generations"]), expires)
+        if evicted:
+            self.metrics.increment("llm_cache_l1_eviction", evicted)
+
+    # single flight - one model call per missed prompt
+
+    def _join_flight(self, key: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        """Lead the flight of the key (return None, the caller calls the model) or wait for its leader"""
+        now = time.monotonic()
+        current = threading.current_thread()
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            # the model call of a leader that did not update within flight_timeout, that looks the prompt up
+            # again or whose thread ended failed - LangChain only calls update on success
+            if flight is None or now - flight[1] > self.flight_timeout or flight[2] is current or not flight[2].is_alive():
+                if flight is not None:
+                    # wake up the waiters of the failed leader, they call the model themselves
+                    flight[0].set()
+                    self.metrics.increment("llm_cache_flight_takeover")
+                self._flights[key] = (threading.Event(), now, current)
+                self.metrics.increment("llm_cache_miss")
+                return None
+        self.metrics.increment("llm_cache_flight_wait")
+        if flight[0].wait(max(0.0, self.flight_timeout - (now - flight[1]))):
+            generations = self._cached(key, llm_string)
+            if generations is not None:
+                return generations
+        self.metrics.increment("llm_cache_miss")
+        return None
+
+    def _end_flight(self, key: str) -> None:
+        with self._flights_lock:
+            flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight[0].set()
+
+    def _embed(self, prompt: str) -> List[float]:
+        start_time = time.perf_counter()
+        vector = self.embeddings.embed_query(normalize_prompt(prompt))
+        self.metrics.record("embed", (time.perf_counter() - start_time) * 1000, table=self.table)
+        return vector
@@ -1,22 +1,310 @@
-from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Sequence
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import (
     BaseMessage,
+    SystemMessage,
     messages_from_dict,
     messages_to_dict,
 )
-from borneo import (Regions, NoSQLHandle, NoSQLHandleConfig,
-                    PutRequest,QueryRequest, DeleteRequest, TableRequest, GetRequest, PutOption,QueryIterableResult, GetTableRequest,
-                    TableNotFoundException, TableLimits, State, TimeToLive)
-from borneo.iam import SignatureProvider
-from borneo.kv import StoreAccessTokenProvider
+from NoSQLDBMetrics import NoSQLDBMetrics, metrics as default_metrics
+from NoSQLDBBackend import (DOCUMENT_STORAGE, MESSAGE_STORAGE, WRITE_MULTIPLE_MAX_OPERATIONS, TABLE_CHECK_TTL,
+                            UNCONDITIONAL, ChatHistoryBackend, BorneoBackend, InMemoryBackend, SQLiteBackend,
+                            NoSQLHandleRegistry, handle_registry, shutdown_handles)
 
 # import the time module
 import time
+import asyncio
+import base64
+import functools
+import json
+import math
+import random
+import zlib
+import threading
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 
 
-#global oracleNoSQL 
-#oracleNoSQL = None;
+# attempts of an append when another writer changed the session concurrently,
+# waiting a random time up to RETRY_BACKOFF * 2^attempt seconds between them
+APPEND_RETRIES = 5
+RETRY_BACKOFF = 0.05
+
+# Payload encodings of the stored messages
+#  compact: the fields left to their default value (empty additional_kwargs, response_metadata, ...) are not stored
+#  zlib   : compact, and the payloads larger than compress_threshold bytes are stored zlib compressed (base64)
+COMPACT_ENCODING = "compact"
+ZLIB_ENCODING = "zlib"
+COMPRESS_THRESHOLD = 1024
+
+# Expiry of the stored messages, enforced by the TTL of the rows so the service reclaims the storage
+#  sliding : the session expires ttl after its last write
+#  absolute: the session expires ttl after its creation, whatever the activity
+#  message : each message expires ttl after it was written (message storage mode), the session loses its oldest messages
+SLIDING_EXPIRY = "sliding"
+ABSOLUTE_EXPIRY = "absolute"
+MESSAGE_EXPIRY = "message"
+# Oracle NoSQL Database TTLs are in hours or days, there is no finer unit
+HOURS = "hours"
+DAYS = "days"
+# the TTL of the older rows of a sliding session (message mode) is refreshed at most every TTL_REFRESH_INTERVAL
+# seconds per backend and session in the process, whatever the number of histories built for it. The refresh
+# gives them TTL_REFRESH_INTERVAL more than the TTL, the appends until the next refresh only set their own rows
+TTL_REFRESH_INTERVAL = 3600
+_ttl_refreshed = weakref.WeakKeyDictionary()
+_ttl_refreshed_lock = threading.Lock()
+
+# additional_kwargs flag of the SystemMessage holding the summary of the compacted messages
+SUMMARY_KWARG = "nosql_summary"
+
+# borneo calls are blocking, the async API runs them on a bounded pool shared by the histories
+ASYNC_MAX_WORKERS = 16
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _default_executor() -> Executor:
+    """Return the thread pool used by the async API, created on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_WORKERS, thread_name_prefix="nosqldb-history")
+        return _executor
+
+
+# fields of the messages dropped by the compact encoding when they have this default value, any other field is kept
+COMPACT_DEFAULTS = {'additional_kwargs': {}, 'response_metadata': {}, 'tool_calls': [], 'invalid_tool_calls': [],
+                    'id': None, 'name': None, 'example': False, 'usage_metadata': None}
+
+
+def _compact_message_dict(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop the message fields left to their default value, messages_from_dict restores them"""
+    data = {key: value for key, value in message['data'].items()
+            if key != 'type' and not (key in COMPACT_DEFAULTS and value == COMPACT_DEFAULTS[key])}
+    return {'type': message['type'], 'data': data}
+
+
+def encode_payload(value: Any, encoding: Optional[str], threshold: int = COMPRESS_THRESHOLD) -> Any:
+    """Encode the stored messages (a list or a single message) with the given payload encoding"""
+    if encoding is None:
+        return value
+    if isinstance(value, list):
+        value = [_compact_message_dict(message) for message in value]
+    else:
+        value = _compact_message_dict(value)
+    if encoding == ZLIB_ENCODING:
+        data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(data) >= threshold:
+            return {'codec': ZLIB_ENCODING, 'data': base64.b64encode(zlib.compress(data)).decode('ascii')}
+    return value
+
+
+def decode_payload(value: Any) -> Any:
+    """Decode a value written by encode_payload, plain JSON is returned as is"""
+    if isinstance(value, dict) and value.get('codec') == ZLIB_ENCODING:
+        return json.loads(zlib.decompress(base64.b64decode(value['data'])))
+    return value
+
+
+def truncating_summarizer(messages: List[BaseMessage], max_chars: int = 2000) -> str:
+    """Deterministic summarizer for tests and benchmarks - keeps the last max_chars of the conversation"""
+    text = "\n".join(f"{message.type}: {message.content}" for message in messages)
+    return text[-max_chars:]
+
+
+def approximate_token_count(message: BaseMessage) -> int:
+    """Cheap token estimate used by max_tokens - about 4 characters per token"""
+    return len(str(message.content)) // 4 + 1
+
+
+class ExpiryPolicy:
+    """When the messages of a session expire.
+
+    Args:
+        ttl: Time-to-live, in unit
+        unit: hours (default) or days, the TTL granularity of Oracle NoSQL Database
+        mode: sliding (default), absolute or message - see SLIDING_EXPIRY, ABSOLUTE_EXPIRY and MESSAGE_EXPIRY
+    """
+    def __init__(self, ttl: int, unit: str = HOURS, mode: str = SLIDING_EXPIRY):
+        if unit not in (HOURS, DAYS):
+            raise ValueError('Unknown TTL unit: ' + str(unit))
+        if mode not in (SLIDING_EXPIRY, ABSOLUTE_EXPIRY, MESSAGE_EXPIRY):
+            raise ValueError('Unknown expiry mode: ' + str(mode))
+        if ttl <= 0:
+            raise ValueError('The TTL must be positive: ' + str(ttl))
+        self.ttl = ttl
+        self.unit = unit
+        self.mode = mode
+
+    @property
+    def hours(self) -> int:
+        """The TTL in hours"""
+        return self.ttl * 24 if self.unit == DAYS else self.ttl
+
+    def __repr__(self) -> str:
+        return f"ExpiryPolicy({self.ttl} {self.unit}, {self.mode})"
+
+
+class CachedSession:
+    """Messages of a session as stored (messages_to_dict form) with their version.
+    The BaseMessage objects are only built when messages is read"""
+    __slots__ = ("stored", "version", "loaded", "_messages")
+
+    def __init__(self, stored: List[Dict[str, Any]], version, messages: Optional[List[BaseMessage]] = None):
+        self.stored = stored
+        self.version = version
+        self.loaded = time.monotonic()
+        self._messages = messages
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        if self._messages is None:
+            self._messages = messages_from_dict(self.stored)
+        return list(self._messages)
+
+    def append(self, stored: List[Dict[str, Any]], messages: Sequence[BaseMessage], version,
+               verified: bool = True) -> "CachedSession":
+        """Return the session with the messages appended, the decoded messages are extended only if built.
+        Unless the put verified the whole session (document mode), the entry keeps the age of the read"""
+        decoded = None if self._messages is None else self._messages + list(messages)
+        session = CachedSession(self.stored + stored, version, decoded)
+        if not verified:
+            session.loaded = self.loaded
+        return session
+
+
+class MessageCache:
+    """In-process LRU cache of the messages of the sessions, shared by the histories.
+
+    Each entry keeps the row version returned by borneo (document mode) or the next sequence
+    (message mode). Appends are conditional on that version so a stale entry is detected by the
+    put itself at no extra cost, then the entry is reloaded. In message mode the put only sees the
+    appends of the other writers, not their clear or compaction: the histories then need a max_age,
+    which bounds how long such an entry is served, the appends do not renew it.
+
+    Args:
+        max_sessions: number of sessions kept, the least recently used session is evicted
+        max_age: Optional number of seconds an entry is trusted for reads, None means until evicted
+    """
+    def __init__(self, max_sessions: int = 1000, max_age: Optional[float] = None):
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[CachedSession]:
+        """Return the CachedSession of the session or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self.max_age is not None and time.monotonic() - entry.loaded > self.max_age:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry: CachedSession) -> None:
+        """Store the session and evict the least recently used sessions"""
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        """Forget the session"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class NoSQLDBBatchWriter:
+    """Buffer the appends of many histories and write them in bulk, e.g. to replay conversations.
+
+    A flush writes the buffered messages of each session at once: in message mode up to
+    WRITE_MULTIPLE_MAX_OPERATIONS rows per WriteMultipleRequest (one shard key per session), in document
+    mode a single put per session. The thresholds are checked on append, there is no background thread.
+
+    Args:
+        max_messages: number of buffered messages that triggers a flush
+        flush_interval: Optional number of seconds after which the next append flushes the buffer
+    """
+    def __init__(self, max_messages: int = 500, flush_interval: Optional[float] = 5.0):
+        self.max_messages = max_messages
+        self.flush_interval = flush_interval
+        self._pending = OrderedDict()
+        self._count = 0
+        self._oldest = None
+        self._lock = threading.RLock()
+
+    def add(self, history: "NoSQLDBChatMessageHistory", messages: Sequence[BaseMessage]) -> None:
+        """Buffer the messages of the history, flushing when a threshold is reached"""
+        with self._lock:
+            entry = self._pending.setdefault(history._cache_key, (history, []))
+            entry[1].extend(messages)
+            self._count += len(messages)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if self._count >= self.max_messages or (
+                    self.flush_interval is not None and time.monotonic() - self._oldest >= self.flush_interval):
+                self.flush()
+
+    def pending(self, history: Optional["NoSQLDBChatMessageHistory"] = None) -> int:
+        """Number of buffered messages, of the history when given"""
+        with self._lock:
+            if history is None:
+                return self._count
+            entry = self._pending.get(history._cache_key)
+            return 0 if entry is None else len(entry[1])
+
+    def flush(self, history: Optional["NoSQLDBChatMessageHistory"] = None) -> None:
+        """Write the buffered messages, only the ones of the history when given"""
+        with self._lock:
+            keys = list(self._pending) if history is None else [history._cache_key]
+            for key in keys:
+                entry = self._pending.pop(key, None)
+                if entry is None:
+                    continue
+                try:
+                    entry[0]._write_messages(entry[1])
+                except Exception:
+                    # only the messages that were not stored are written again
+                    written = entry[0]._written
+                    del entry[1][:written]
+                    self._count -= written
+                    if entry[1]:
+                        self._pending[key] = entry
+                        self._pending.move_to_end(key, last=False)
+                    elif not self._pending:
+                        self._oldest = None
+                    raise
+                self._count -= len(entry[1])
+            if not self._pending:
+                self._oldest = None
+
+    def discard(self, history: "NoSQLDBChatMessageHistory") -> None:
+        """Drop the buffered messages of the history"""
+        with self._lock:
+            entry = self._pending.pop(history._cache_key, None)
+            if entry is not None:
+                self._count -= len(entry[1])
+            if not self._pending:
+                self._oldest = None
+
+    def close(self) -> None:
+        """Flush everything"""
+        self.flush()
+
+    def __enter__(self) -> "NoSQLDBBatchWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
 
 class NoSQLDBChatMessageHistory(BaseChatMessageHistory):
     """Chat message history that stores history in Oracle NoSQL DB.
@@ -27,8 +315,52 @@ class NoSQLDBChatMessageHistory(BaseChatMessageHistory):
         compartment_id: name of the compartment to use
         session_id: arbitrary key that is used to store the messages
             of a single chat session.
-        ttl: Optional Time-to-live (TTL) in minutes
+        ttl: Optional Time-to-live (TTL) in hours of the session after its last write,
+           the same as expiry=ExpiryPolicy(ttl)
         ru,wu,storage : default limits for the table
+        storage_mode: how the messages are stored in the table
+           document (default): one row per session (id STRING, items JSON), the whole session is rewritten on append.
+           message: one row per message (id STRING, seq LONG, message JSON), appending only writes the new messages
+           and the session is read with a single shard range scan. Use a dedicated table, the schemas are different.
+        message_cache: Optional MessageCache shared by the histories, kept in sync by add_messages and clear.
+           Saves the read of the session on every turn. The message storage mode needs a cache with a max_age.
+        shared_handle: reuse the handle of the process-wide handle_registry (default) instead of
+           opening a new connection, close_handle then only releases it.
+        ensure_table: check that the table exists and create it if needed (default). The check is
+           remembered per handle and table for TABLE_CHECK_TTL seconds. Use False when the table is provisioned.
+        executor: Optional Executor running the borneo calls of aget_messages, aadd_messages, aclear and the prefetch,
+           by default a thread pool of ASYNC_MAX_WORKERS threads shared by the histories.
+        max_messages: Optional number of most recent messages returned by messages
+        max_tokens: Optional token budget of the messages returned by messages, the most recent first.
+           In message mode only the tail rows are read, the cost of a read does not grow with the session. In document
+           mode max_messages only shrinks the data returned (the row is still read whole and billed by its size, a
+           zlib encoded row is returned whole), and max_tokens alone reads the whole session then keeps its tail.
+        token_counter: Optional function counting the tokens of a message for max_tokens,
+           approximate_token_count by default
+        payload_encoding: Optional encoding of the stored messages, read back transparently
+           None (default): plain messages_to_dict JSON
+           compact: the fields left to their default value are not stored
+           zlib: compact, and payloads of compress_threshold bytes or more are stored zlib compressed
+        compress_threshold: size in bytes of the JSON payload from which zlib compresses (COMPRESS_THRESHOLD)
+        summarizer: Optional function turning a list of messages into a summary text (e.g. an LLM call,
+           truncating_summarizer for tests). When a session exceeds compaction_threshold messages or
+           compaction_max_bytes (document mode), the older messages are replaced by a SystemMessage holding
+           the summary and the last compaction_keep messages are kept verbatim.
+        compaction_threshold: Optional number of stored messages that triggers the compaction
+        compaction_max_bytes: Optional size in bytes of the session (document mode) that triggers the compaction
+        compaction_keep: number of most recent messages kept verbatim by the compaction
+        batch_writer: Optional NoSQLDBBatchWriter buffering add_messages. The buffered messages of the
+           session are flushed before messages is read and when the handle is closed.
+        metrics: Optional NoSQLDBMetrics recording the latency, units and sizes of every operation,
+           the process-wide NoSQLDBMetrics.metrics by default
+        prefetch: start reading the session in the background (on executor) at construction, the first access
+           to messages then waits for that read instead of starting its own. See start_prefetch.
+        backend: Optional ChatHistoryBackend storing the messages instead of Oracle NoSQL Database, e.g.
+           InMemoryBackend or SQLiteBackend for tests and benchmarks. The region and auth arguments are then
+           not used and close_handle does not close the backend, its owner does.
+        expiry: Optional ExpiryPolicy of the session, sliding, absolute or per message (message storage mode).
+           A sliding session in message mode refreshes the TTL of its older rows at most once an hour per process (TTL_REFRESH_INTERVAL),
+           giving them the TTL plus that interval.
         SAME AUTH as for ChatOCIGenAI
         auth_type: str
            The authentication type to use, e.g., API_KEY (default), SECURITY_TOKEN, INSTANCE_PRINCIPAL, RESOURCE_PRINCIPAL.
@@ -47,44 +379,84 @@ class NoSQLDBChatMessageHistory(BaseChatMessageHistory):
         ttl: Optional[int] = None,
         auth_type: Optional[str] = "API_KEY",
         auth_profile: Optional[str] = "DEFAULT",
-        auth_file_location: Optional[str] = "~/.oci/config",        
+        auth_file_location: Optional[str] = "~/.oci/config",
         ru: Optional[str] = 10,
         wu: Optional[str] = 10,
         storage: Optional[str] = 1,
+        storage_mode: Optional[str] = DOCUMENT_STORAGE,
+        message_cache: Optional[MessageCache] = None,
+        shared_handle: bool = True,
+        ensure_table: bool = True,
+        executor: Optional[Executor] = None,
+        max_messages: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        token_counter: Optional[Callable[[BaseMessage], int]] = None,
+        payload_encoding: Optional[str] = None,
+        compress_threshold: int = COMPRESS_THRESHOLD,
+        summarizer: Optional[Callable[[List[BaseMessage]], str]] = None,
+        compaction_threshold: Optional[int] = None,
+        compaction_max_bytes: Optional[int] = None,
+        compaction_keep: int = 10,
+        batch_writer: Optional[NoSQLDBBatchWriter] = None,
+        metrics: Optional[NoSQLDBMetrics] = None,
+        prefetch: bool = False,
+        backend: Optional[ChatHistoryBackend] = None,
+        expiry: Optional[ExpiryPolicy] = None,
     ):
-        
+
+        if storage_mode not in (DOCUMENT_STORAGE, MESSAGE_STORAGE):
+            raise ValueError('Unknown storage mode: ' + str(storage_mode))
+        if payload_encoding not in (None, COMPACT_ENCODING, ZLIB_ENCODING):
+            raise ValueError('Unknown payload encoding: ' + str(payload_encoding))
+        if ttl is not None:
+            if expiry is not None:
+                raise ValueError('Use either ttl or expiry')
+            expiry = ExpiryPolicy(ttl)
+        if expiry is not None and expiry.mode == MESSAGE_EXPIRY and storage_mode != MESSAGE_STORAGE:
+            raise ValueError('The message expiry needs the message storage mode')
+        if message_cache is not None and storage_mode == MESSAGE_STORAGE and message_cache.max_age is None:
+            # the put of a new sequence does not see a clear or a compaction by another writer
+            raise ValueError('The message cache needs a max_age in the message storage mode')
+
         self.region = region
         self.table = table_name
         self.compartment_id = compartment_id
         self.session_id = session_id
-        self.ttl = ttl
-        self._debug = ""
-
-        print("Connecting to the Oracle NoSQL Cloud Service: " + self.session_id)
-        
-        if auth_type == "API_KEY":
-           provider = SignatureProvider(config_file=auth_file_location, profile_name=auth_profile);
-        elif auth_type == "INSTANCE_PRINCIPAL":
-           provider = SignatureProvider.create_with_instance_principal();
-        elif auth_type == "RESOURCE_PRINCIPAL":
-           provider = SignatureProvider.create_with_resource_principal();        
-        else:
-           raise IllegalArgumentException('Unknown environment: ' + nosql_env)
-        config = NoSQLHandleConfig(self.region, provider).set_logger(None)
-        config.set_default_compartment(self.compartment_id)
-        #if oracleNoSQL is None:
-        #   oracleNoSQL = NoSQLHandle(config)
-        # self.handle  = oracleNoSQL
-        self.handle = NoSQLHandle(config)
-
-        # creating table if not exists - avoid borneo.exception.OperationThrottlingException: Tenant exceeded DDL operation rate limit.
-        try:
-            getTableRequest = GetTableRequest().set_table_name(self.table)
-            result = self.handle.get_table(getTableRequest)
-        except TableNotFoundException as e:
-            statement = ('Create table if not exists {} (id STRING, items JSON, primary key(id))').format(self.table)
-            request = TableRequest().set_statement(statement).set_table_limits(TableLimits(ru, wu, storage))
-            self.handle.do_table_request(request, 50000, 3000)
+        self.expiry = expiry
+        self.storage_mode = storage_mode
+        self.message_cache = message_cache
+        self.executor = executor
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.token_counter = token_counter if token_counter is not None else approximate_token_count
+        self.payload_encoding = payload_encoding
+        self.compress_threshold = compress_threshold
+        self.summarizer = summarizer
+        self.compaction_threshold = compaction_threshold
+        self.compaction_max_bytes = compaction_max_bytes
+        self.compaction_keep = compaction_keep
+        self.batch_writer = batch_writer
+        self.metrics = metrics if metrics is not None else default_metrics
+        self._first_seq = None
+        self._cache_key = (self.region, self.compartment_id, self.table, self.session_id)
+        self._next_seq = None
+        # number of the messages of the last _write_messages stored, even when it failed afterwards
+        self._written = 0
+        self._session_expires = None
+        self._debug_lines = deque(maxlen=10)
+        self._prefetch = None
+
+        self._owns_backend = backend is None
+        if backend is None:
+            backend = BorneoBackend.connect(self.region, self.compartment_id, auth_type, auth_profile,
+                                            auth_file_location, shared_handle, self.metrics)
+        self.backend = backend
+        self.handle = backend.handle
+
+        if ensure_table:
+            self.backend.ensure_table(self.table, self.storage_mode, (ru, wu, storage))
+        if prefetch:
+            self.start_prefetch()
 
     @property
     def messages(self) -> List[BaseMessage]:
@@ -96,20 +468,34 @@ class NoSQLDBChatMessageHistory(BaseChatMessageHistory):
         #     model.invoke([HumanMessage("Who build pyramides")])
         # ]
         # stored_messages = messages_to_dict(messages)
+        if self.batch_writer is not None and self.batch_writer.pending(self):
+            self.batch_writer.flush(self)
+        prefetched = self._take_prefetch()
+        if prefetched is not None:
+            self.metrics.increment("prefetch_hit")
+            return prefetched
+        return self._read_messages()
+
+    def _read_messages(self) -> List[BaseMessage]:
+        """Read the messages from the cache or NoSQLDB"""
+        if self.message_cache is not None:
+            cached = self.message_cache.get(self._cache_key)
+            if cached is not None:
+                self.metrics.increment("cache_hit")
+                self.add_debug_message("Retrieved messages from cache")
+                return self._window(cached.messages)
+            self.metrics.increment("cache_miss")
+        if self.max_messages is not None or self.max_tokens is not None:
+            if self.storage_mode == MESSAGE_STORAGE or self.max_messages is not None:
+                return self._load_tail()
+        stored, version = self._load_stored()
         # Use perf_counter for higher precision timing
         start_time = time.perf_counter()
-        request = GetRequest().set_key({'id': self.session_id}).set_table_name(self.table)
-        result = self.handle.get(request)
-        end_time = time.perf_counter()
-        elapsed_time = end_time - start_time
-        if result.get_value() is None:
-          retrieved_messages = []
-        else:
-          retrieved_messages = result.get_value()['items']
-        messages = messages_from_dict(retrieved_messages)
-        self.add_debug_message(f"Retrieved messages from NoSQLDB: {elapsed_time * 1000:.2f} milliseconds")
-
-        return messages
+        messages = messages_from_dict(stored)
+        self._record("decode_messages", start_time, len(messages), "Decoded the messages")
+        if self.message_cache is not None:
+            self.message_cache.put(self._cache_key, CachedSession(stored, version, messages))
+        return self._window(messages)
 
     @messages.setter
     def messages(self, messages: List[BaseMessage]) -> None:
@@ -118,40 +504,395 @@ class NoSQLDBChatMessageHistory(BaseChatMessageHistory):
             " Use the 'add_messages' instead."
         )
 
-    def add_messages(self, messages: Sequence[BaseMessage]) -> None:        
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
         """Append the message to the record in NoSQLDB"""
-        existing_messages = messages_to_dict(self.messages)
-        existing_messages.extend(messages_to_dict(messages))
-        
+        if self.batch_writer is not None:
+            self.batch_writer.add(self, messages)
+            return
+        self._write_messages(messages)
+
+    def _write_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Append the messages to NoSQLDB now"""
+        if not messages:
+            return
+        # a read still running would return the session without these messages
+        self._take_prefetch()
         # Use perf_counter for higher precision timing
         start_time = time.perf_counter()
-        request = PutRequest().set_table_name(self.table)
-        if self.ttl is not None:
-            request.set_ttl (TimeToLive.of_hours(self.ttl))
-        request.set_value({"id":self.session_id , "items":existing_messages})
-        result = self.handle.put(request)
-        end_time = time.perf_counter()
-        elapsed_time = end_time - start_time
-        self.add_debug_message(f"Append the messages to NoSQLDB: {elapsed_time * 1000:.2f} milliseconds")
+        self._written = 0
+        self._append(messages)
+        self._record("add_messages", start_time, len(messages), "Append the messages to NoSQLDB")
+
+    def _append(self, messages: Sequence[BaseMessage]) -> None:
+        """Append the messages in the storage mode of the history"""
+        cached = None
+        if self.message_cache is not None:
+            cached = self.message_cache.get(self._cache_key)
+
+        new_messages = messages_to_dict(messages)
+        if self.storage_mode == MESSAGE_STORAGE:
+            if cached is not None:
+                self._next_seq = cached.version
+            first_seq = self._append_message_rows(new_messages)
+            if first_seq:
+                self._refresh_session_ttl()
+            if cached is not None and first_seq == cached.version:
+                self.message_cache.put(self._cache_key,
+                                       cached.append(new_messages, messages, self._next_seq, verified=False))
+            elif self.message_cache is not None:
+                # another writer appended to the session - the cached messages are stale
+                self.message_cache.invalidate(self._cache_key)
+            if self.summarizer is not None and self.compaction_threshold is not None:
+                if self._next_seq - self._first_sequence() > self.compaction_threshold:
+                    self._compact_message_rows()
+            return
+
+        # the stored messages are appended as dicts, no BaseMessage is built for them
+        # optimistic concurrency - the put only succeeds if the row still has the version that was read
+        for attempt in range(APPEND_RETRIES):
+            if cached is None:
+                cached = CachedSession(*self._load_stored())
+            stored = cached.stored + new_messages
+            new_version = self._put_document(stored, cached.version)
+            if new_version is not None:
+                break
+            # another writer changed the session - reload it and try again
+            cached = None
+            self._conflict(attempt)
+        else:
+            raise RuntimeError('Unable to append the messages to NoSQLDB: ' + self.session_id)
+        self._written = len(new_messages)
+        if self.message_cache is not None:
+            self.message_cache.put(self._cache_key, cached.append(new_messages, messages, new_version))
+        if self.summarizer is not None and self._needs_compaction(stored):
+            self._compact_document(stored, new_version)
 
     def clear(self) -> None:
         """Clear session memory from NoSQLDB"""
-        print("Delete the messages to NoSQLDB: " + self.session_id )      
-        request = DeleteRequest().set_key({'id': self.session_id}).set_table_name(self.table)
-        result = self.handle.delete(request)
+        print("Delete the messages to NoSQLDB: " + self.session_id )
+        if self.batch_writer is not None:
+            self.batch_writer.discard(self)
+        self._take_prefetch()
+        if self.storage_mode == MESSAGE_STORAGE:
+            self._delete_message_rows()
+            # another writer may append meanwhile, the next append reads the last sequence
+            self._next_seq = None
+            self._first_seq = None
+            self._session_expires = None
+            self._forget_ttl_refresh()
+        else:
+            self.backend.delete_document(self.table, self.session_id)
+        if self.message_cache is not None:
+            self.message_cache.put(self._cache_key, CachedSession([], 0 if self.storage_mode == MESSAGE_STORAGE else None, []))
+
+    def start_prefetch(self) -> Future:
+        """Start reading the session in the background, the next access to messages returns this read.
+        An append or a clear before that waits for the read and drops it"""
+        if self._prefetch is None:
+            executor = self.executor if self.executor is not None else _default_executor()
+            self._prefetch = executor.submit(self._read_messages)
+        return self._prefetch
+
+    def _take_prefetch(self) -> Optional[List[BaseMessage]]:
+        """Wait for the prefetch and return its messages, None when there is none or it failed"""
+        future, self._prefetch = self._prefetch, None
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            self.add_debug_message("Prefetch failed: " + str(e))
+            return None
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        """Retrieve the messages from NoSQLDB without blocking the event loop"""
+        return await self._run_blocking(lambda: self.messages)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Append the messages to NoSQLDB without blocking the event loop"""
+        await self._run_blocking(self.add_messages, list(messages))
+
+    async def aclear(self) -> None:
+        """Clear session memory from NoSQLDB without blocking the event loop"""
+        await self._run_blocking(self.clear)
+
+    async def _run_blocking(self, func, *args):
+        """Run a blocking call on the executor of the history"""
+        loop = asyncio.get_running_loop()
+        executor = self.executor if self.executor is not None else _default_executor()
+        return await loop.run_in_executor(executor, functools.partial(func, *args))
 
     def close_handle(self) -> None:
-        """Clear session memory from NoSQLDB"""
-        if self.handle is not None:
-           print("Close the connection to the Oracle NoSQL Cloud Service")
-           self.handle.close()
+        """Close the connection, or give the shared handle back to the handle_registry"""
+        if self.backend is None:
+           return
+        if self.batch_writer is not None:
+           self.batch_writer.flush(self)
+        self._take_prefetch()
+        if self._owns_backend:
+           self.backend.close()
+        self.backend = None
+        self.handle = None
 
     def add_debug_message(self, message):
-        """Add debug message - keeping only the 10 last lines"""        
-        self._debug += f"\n{message}"
-        debug_lines = self._debug.split('\n')
-        last_10_lines = debug_lines[-10:]
-        self._debug = '\n'.join(last_10_lines)
-        if self._debug and not self._debug.startswith('\n'):
-            self._debug = '\n' + self._debug
-            
\ No newline at end of file
+        """Add debug message - keeping only the 10 last lines"""
+        self._debug_lines.append(message)
+
+    @property
+    def _debug(self) -> str:
+        """The 10 last debug lines, each one starting with a new line"""
+        return "".join(f"\n{line}" for line in self._debug_lines)
+
+    def _conflict(self, attempt: int) -> None:
+        """Count a concurrent update, forget the cached session and wait before the next attempt"""
+        self.metrics.increment("conflict")
+        if self.message_cache is not None:
+            self.message_cache.invalidate(self._cache_key)
+        self.add_debug_message(f"Concurrent update of the session, attempt {attempt + 1}")
+        if attempt + 1 < APPEND_RETRIES:
+            time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+
+    # expiry - the TTL of the written rows
+
+    def _document_ttl(self, creating: bool) -> Optional[int]:
+        """TTL in hours of a written session row, None keeps the expiration of the existing row"""
+        if self.expiry is None or (self.expiry.mode == ABSOLUTE_EXPIRY and not creating):
+            return None
+        return self.expiry.hours
+
+    def _message_ttl(self) -> Optional[int]:
+        """TTL in hours of the appended message rows"""
+        if self.expiry is None or self.expiry.mode != ABSOLUTE_EXPIRY:
+            return None if self.expiry is None else self.expiry.hours
+        # the new rows expire with the oldest one, which was written when the session was created
+        if self._session_expires is None:
+            remaining = self.backend.session_expiration(self.table, self.session_id)
+            if remaining is None:
+                remaining = self.expiry.hours * 3600
+            self._session_expires = self.backend.clock() + remaining
+        return max(1, math.ceil((self._session_expires - self.backend.clock()) / 3600))
+
+    def _refresh_session_ttl(self) -> None:
+        """Push back the expiration of the older rows of a sliding session, at most once per TTL_REFRESH_INTERVAL
+        in the process - the expiration time is rounded up to the hour by the service anyway"""
+        if self.expiry is None or self.expiry.mode != SLIDING_EXPIRY:
+            return
+        now = self.backend.clock()
+        with _ttl_refreshed_lock:
+            refreshed = _ttl_refreshed.setdefault(self.backend, OrderedDict())
+            # the sessions are in refresh order, forget the ones refreshed more than an interval ago
+            while refreshed and now - next(iter(refreshed.values())) >= TTL_REFRESH_INTERVAL:
+                refreshed.popitem(last=False)
+            if self._cache_key in refreshed:
+                return
+            # claimed before the update, concurrent appends of the session do not refresh it again
+            refreshed[self._cache_key] = now
+        start_time = time.perf_counter()
+        try:
+            # covers the appends of the next interval, which do not refresh the older rows
+            self.backend.refresh_ttl(self.table, self.session_id,
+                                     self.expiry.hours + math.ceil(TTL_REFRESH_INTERVAL / 3600))
+        except Exception:
+            self._forget_ttl_refresh()
+            raise
+        self._record("refresh_ttl", start_time, 0, "Refreshed the TTL of the session")
+
+    def _forget_ttl_refresh(self) -> None:
+        """The next append of the session refreshes the TTL of its rows"""
+        with _ttl_refreshed_lock:
+            _ttl_refreshed.get(self.backend, {}).pop(self._cache_key, None)
+
+    def _record(self, operation: str, start_time: float, messages: int, description: str) -> None:
+        """Record a history level operation started at start_time and add its debug message"""
+        elapsed_time = time.perf_counter() - start_time
+        self.metrics.record(operation, elapsed_time * 1000, messages=messages, table=self.table)
+        self.add_debug_message(f"{description}: {elapsed_time * 1000:.2f} milliseconds")
+
+    def _load_stored(self) -> tuple:
+        """Read the session from NoSQLDB, return the stored messages (dicts) and the version to cache"""
+        # Use perf_counter for higher precision timing
+        start_time = time.perf_counter()
+        if self.storage_mode == MESSAGE_STORAGE:
+            stored = self._get_message_rows()
+            version = self._next_seq
+        else:
+            stored, version = self._get_document()
+        self._record("read_messages", start_time, len(stored), "Retrieved messages from NoSQLDB")
+        return stored, version
+
+    def _window(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """Keep the most recent messages within max_messages and max_tokens"""
+        if self.max_messages is not None:
+            messages = messages[-self.max_messages:] if self.max_messages > 0 else []
+        if self.max_tokens is None:
+            return messages
+        tokens = 0
+        start = len(messages)
+        while start > 0:
+            tokens += self.token_counter(messages[start - 1])
+            if tokens > self.max_tokens:
+                break
+            start -= 1
+        return messages[start:]
+
+    def _load_tail(self) -> List[BaseMessage]:
+        """Read only the most recent messages of the session within max_messages and max_tokens"""
+        # Use perf_counter for higher precision timing
+        start_time = time.perf_counter()
+        if self.storage_mode == MESSAGE_STORAGE:
+            messages = self._get_message_tail()
+        else:
+            items = self.backend.get_document_tail(self.table, self.session_id, self.max_messages)
+            messages = self._window(messages_from_dict(decode_payload(items) if items is not None else []))
+        self._record("read_tail", start_time, len(messages), f"Retrieved {len(messages)} last messages from NoSQLDB")
+        return messages
+
+    # compaction - older messages replaced by a summary
+
+    def _summary_message(self, messages: List[BaseMessage]) -> BaseMessage:
+        """Summarize the messages, a previous summary being the first of them"""
+        start_time = time.perf_counter()
+        summary = self.summarizer(messages)
+        self._record("summarize", start_time, len(messages), f"Summarized {len(messages)} messages")
+        return SystemMessage(content=summary, additional_kwargs={SUMMARY_KWARG: True})
+
+    def _needs_compaction(self, stored: List[Dict[str, Any]]) -> bool:
+        """True when the session is over the compaction message or byte budget"""
+        if len(stored) <= self.compaction_keep + 1:
+            return False
+        if self.compaction_threshold is not None and len(stored) > self.compaction_threshold:
+            return True
+        if self.compaction_max_bytes is not None:
+            return len(json.dumps(stored, separators=(',', ':'))) > self.compaction_max_bytes
+        return False
+
+    def _compact_document(self, stored: List[Dict[str, Any]], version) -> None:
+        """Rewrite the session row as [summary] + tail, unless another writer changed it meanwhile"""
+        split = len(stored) - self.compaction_keep
+        # only the summarized messages are decoded, the tail is kept as stored
+        summary = self._summary_message(messages_from_dict(stored[:split]))
+        compacted = messages_to_dict([summary]) + stored[split:]
+        new_version = self._put_document(compacted, version)
+        if new_version is None:
+            # another writer appended meanwhile, the next append compacts
+            self.metrics.increment("compaction_conflict")
+        if self.message_cache is not None:
+            if new_version is not None:
+                self.message_cache.put(self._cache_key, CachedSession(compacted, new_version))
+            else:
+                self.message_cache.invalidate(self._cache_key)
+
+    def _compact_message_rows(self) -> None:
+        """Overwrite the last compacted row with the summary then delete the rows before it"""
+        rows = self._scan_message_rows()
+        if len(rows) <= self.compaction_keep + 1:
+            return
+        split = len(rows) - self.compaction_keep
+        head = messages_from_dict([decode_payload(row['message']) for row in rows[:split]])
+        summary_seq = rows[split - 1]['seq']
+        summary = messages_to_dict([self._summary_message(head)])[0]
+        self.backend.put_rows(self.table, self.session_id,
+                              [(summary_seq, encode_payload(summary, self.payload_encoding, self.compress_threshold))],
+                              self._document_ttl(False), if_absent=False)
+        # a failure here leaves older rows before the summary, nothing is lost
+        self._delete_message_rows(summary_seq)
+        self._first_seq = summary_seq
+        if self.message_cache is not None:
+            self.message_cache.invalidate(self._cache_key)
+
+    # document storage mode - one row per session
+
+    def _get_document(self) -> tuple:
+        """Read the session row, return the stored messages and the row version"""
+        items, version = self.backend.get_document(self.table, self.session_id)
+        if items is None:
+          return [], None
+        return decode_payload(items), version
+
+    def _put_document(self, stored_messages: List[Dict[str, Any]], match_version=UNCONDITIONAL):
+        """Write the session row, optionally only if the row still has match_version (None: row absent).
+        Return the new version, None when the condition failed"""
+        items = encode_payload(stored_messages, self.payload_encoding, self.compress_threshold)
+        return self.backend.put_document(self.table, self.session_id, items, match_version,
+                                         self._document_ttl(match_version is None), messages=len(stored_messages))
+
+    # message storage mode - one row per message
+
+    def _scan_message_rows(self) -> List[Dict[str, Any]]:
+        """All the rows of the session in sequence order"""
+        rows = []
+        for results in self.backend.scan_rows(self.table, self.session_id):
+            rows.extend(results)
+        return rows
+
+    def _get_message_rows(self) -> List[Dict[str, Any]]:
+        """Range scan the rows of the session in sequence order"""
+        rows = self._scan_message_rows()
+        self._next_seq = rows[-1]['seq'] + 1 if rows else 0
+        self._first_seq = rows[0]['seq'] if rows else None
+        return [decode_payload(row['message']) for row in rows]
+
+    def _get_message_tail(self) -> List[BaseMessage]:
+        """Scan the rows of the session backwards until max_messages or max_tokens is reached"""
+        batch_size = self.max_messages if self.max_messages is not None else 20
+        if batch_size <= 0:
+            return []
+        tail = []
+        tokens = 0
+        newest = True
+        for rows in self.backend.scan_rows(self.table, self.session_id, reverse=True, batch_size=batch_size):
+            for row in rows:
+                if newest:
+                    self._next_seq = row['seq'] + 1
+                    newest = False
+                message = messages_from_dict([decode_payload(row['message'])])[0]
+                if self.max_tokens is not None:
+                    tokens += self.token_counter(message)
+                    if tokens > self.max_tokens:
+                        return tail[::-1]
+                tail.append(message)
+                if self.max_messages is not None and len(tail) >= self.max_messages:
+                    return tail[::-1]
+        return tail[::-1]
+
+    def _first_sequence(self) -> int:
+        """Return the sequence of the oldest row of the session, reading only its key when unknown"""
+        if self._first_seq is None:
+            first_seq = self.backend.first_sequence(self.table, self.session_id)
+            self._first_seq = 0 if first_seq is None else first_seq
+        return self._first_seq
+
+    def _delete_message_rows(self, end_seq: Optional[int] = None) -> None:
+        """Delete the rows of the session, only the ones before end_seq when given"""
+        self.backend.delete_rows(self.table, self.session_id, end_seq)
+
+    def _next_sequence(self) -> int:
+        """Return the next free sequence of the session, reading it only when unknown"""
+        if self._next_seq is None:
+            last_seq = self.backend.last_sequence(self.table, self.session_id)
+            self._next_seq = 0 if last_seq is None else last_seq + 1
+        return self._next_seq
+
+    def _append_message_rows(self, stored_messages: List[Dict[str, Any]]) -> int:
+        """Write one row per message, all the rows share the shard key so each chunk is atomic.
+        Return the sequence of the first message"""
+        first_seq = None
+        ttl = self._message_ttl()
+        for start in range(0, len(stored_messages), self.backend.max_batch):
+            chunk = [encode_payload(message, self.payload_encoding, self.compress_threshold)
+                     for message in stored_messages[start:start + self.backend.max_batch]]
+            for attempt in range(APPEND_RETRIES):
+                seq = self._next_sequence()
+                rows = [(seq + offset, message) for offset, message in enumerate(chunk)]
+                if self.backend.put_rows(self.table, self.session_id, rows, ttl):
+                    if first_seq is None:
+                        first_seq = seq
+                    self._next_seq = seq + len(chunk)
+                    self._written += len(chunk)
+                    break
+                # another writer used this sequence - reload the last sequence and try again
+                self._next_seq = None
+                self._conflict(attempt)
+            else:
+                raise RuntimeError('Unable to append the messages to NoSQLDB: ' + self.session_id)
+        return first_seq
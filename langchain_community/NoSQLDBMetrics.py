@@ -0,0 +1,171 @@
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from collections import deque
+
+# import the time module
+import time
+import math
+import threading
+
+# upper bounds in milliseconds of the latency histogram buckets
+DEFAULT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# usage reported by the borneo results
+USAGE_FIELDS = ("read_units", "write_units", "read_kb", "write_kb")
+
+
+class _OperationStats:
+    """Latency histogram, recent samples and usage totals of one operation"""
+    def __init__(self, buckets: Sequence[float], samples: int):
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total_ms = 0.0
+        self.recent = deque(maxlen=samples)
+        self.usage = dict.fromkeys(USAGE_FIELDS + ("messages",), 0)
+
+
+class NoSQLDBMetrics:
+    """Registry of the latency and usage of the operations of the chat history layer.
+
+    Each operation (get, put, delete, query, write_multiple, get_table, ...) records its latency in a
+    histogram, the read/write units and KB consumed, and the number of messages. Percentiles are computed
+    on the last samples of each operation, export_prometheus returns the Prometheus text format and the
+    listeners receive every operation as a span-like event (name, start, duration_ms, attributes).
+
+    Args:
+        prefix: prefix of the exported metric names
+        buckets: upper bounds in milliseconds of the latency histogram
+        samples: number of recent samples kept per operation for the percentiles
+    """
+    def __init__(self, prefix: str = "nosqldb_history", buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 samples: int = 1024):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.samples = samples
+        self._operations = {}
+        self._counters = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener: Callable[[Dict[str, Any]], None]) -> None:
+        """Call listener with an event dict for every recorded operation"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[Dict[str, Any]], None]) -> None:
+        """Stop calling listener"""
+        self._listeners.remove(listener)
+
+    def record(self, operation: str, elapsed_ms: float, result: Any = None, messages: int = 0, **attributes) -> None:
+        """Record one operation, the usage is read from the borneo result when given"""
+        usage = {field: 0 for field in USAGE_FIELDS}
+        if result is not None:
+            for field in USAGE_FIELDS:
+                getter = getattr(result, "get_" + field, None)
+                if getter is not None:
+                    usage[field] = getter() or 0
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = _OperationStats(self.buckets, self.samples)
+            stats.count += 1
+            stats.total_ms += elapsed_ms
+            stats.recent.append(elapsed_ms)
+            for index, bound in enumerate(self.buckets):
+                if elapsed_ms <= bound:
+                    stats.bucket_counts[index] += 1
+                    break
+            for field, value in usage.items():
+                stats.usage[field] += value
+            stats.usage["messages"] += messages
+        if self._listeners:
+            attributes.update(usage)
+            attributes["messages"] = messages
+            event = {"name": operation, "start": time.time() - elapsed_ms / 1000,
+                     "duration_ms": elapsed_ms, "attributes": attributes}
+            for listener in list(self._listeners):
+                try:
+                    listener(event)
+                except Exception as e:
+                    print("NoSQLDBMetrics listener failed: " + str(e))
+
+    def increment(self, counter: str, value: int = 1) -> None:
+        """Increment an event counter (cache hits, conflicts, ...)"""
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def counter(self, counter: str) -> int:
+        """Value of an event counter"""
+        with self._lock:
+            return self._counters.get(counter, 0)
+
+    def percentile(self, operation: str, percent: float) -> Optional[float]:
+        """Latency percentile in milliseconds of the recent samples of the operation"""
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None or not stats.recent:
+                return None
+            samples = sorted(stats.recent)
+        # nearest rank
+        index = min(len(samples) - 1, max(0, math.ceil(percent / 100 * len(samples)) - 1))
+        return samples[index]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counts, latency percentiles and usage of every operation, and the event counters"""
+        with self._lock:
+            names = list(self._operations)
+            counters = dict(self._counters)
+        operations = {}
+        for name in names:
+            stats = self._operations.get(name)
+            if stats is None:
+                continue
+            operations[name] = dict(
+                count=stats.count,
+                mean_ms=stats.total_ms / stats.count if stats.count else 0.0,
+                p50_ms=self.percentile(name, 50),
+                p95_ms=self.percentile(name, 95),
+                p99_ms=self.percentile(name, 99),
+                **stats.usage,
+            )
+        return {"operations": operations, "counters": counters}
+
+    def summary(self) -> List[str]:
+        """One line per operation, for logs and the Streamlit app"""
+        lines = []
+        for name, stats in self.snapshot()["operations"].items():
+            lines.append(f"{name}: {stats['count']} calls, p50 {stats['p50_ms']:.2f} ms, p95 {stats['p95_ms']:.2f} ms, "
+                         f"p99 {stats['p99_ms']:.2f} ms, {stats['read_units']} RU, {stats['write_units']} WU")
+        return lines
+
+    def export_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        name = self.prefix + "_operation_duration_ms"
+        lines = [f"# TYPE {name} histogram"]
+        with self._lock:
+            for operation, stats in self._operations.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, stats.bucket_counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{operation="{operation}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{operation="{operation}",le="+Inf"}} {stats.count}')
+                lines.append(f'{name}_sum{{operation="{operation}"}} {stats.total_ms}')
+                lines.append(f'{name}_count{{operation="{operation}"}} {stats.count}')
+            for field in USAGE_FIELDS + ("messages",):
+                total = f"{self.prefix}_{field}_total"
+                lines.append(f"# TYPE {total} counter")
+                for operation, stats in self._operations.items():
+                    lines.append(f'{total}{{operation="{operation}"}} {stats.usage[field]}')
+            events = self.prefix + "_events_total"
+            lines.append(f"# TYPE {events} counter")
+            for counter, value in self._counters.items():
+                lines.append(f'{events}{{event="{counter}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        """Forget everything recorded"""
+        with self._lock:
+            self._operations.clear()
+            self._counters.clear()
+
+
+# registry used by the histories when none is given
+metrics = NoSQLDBMetrics()
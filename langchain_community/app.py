@@ -31,49 +31,70 @@ with st.sidebar:
     top_k = st.sidebar.slider('top_k', min_value=5, max_value=100, value=50, step=1)
     max_tokens = st.sidebar.slider('max_tokens', min_value=32, max_value=700, value=100, step=10)
     with_history = st.sidebar.toggle('With Memory Context', value=True)
+    streaming = st.sidebar.toggle('Stream the answer', value=True)
     st.markdown('📖 Learn about this project (https://github.com/dario-vega/nosql-ai-proof-of-concept/')
 
-model = ChatOCIGenAI(
-    model_id=llm ,  
-    service_endpoint="https://inference.generativeai.us-chicago-1.oci.oraclecloud.com",
-    compartment_id="ocid1.compartment.oc1..aaaaaaaa4mlehopmvdluv2wjcdp4tnh2ypjz3nhhpahb4ss7yvxaa3be3diq",
-    model_kwargs={"temperature": temperature, "max_tokens": max_tokens, "top_p": top_p, "top_k": top_k},
-)
-
 ## Initialize the NoSQLDB chat message history
-from  NoSQLDBChatMessageHistory import NoSQLDBChatMessageHistory
+from  NoSQLDBChatMessageHistory import NoSQLDBChatMessageHistory, MessageCache
 table_name = "SessionTable"
 session_id = st.session_state.session_id
 compartment_id="ocid1.compartment.oc1..aaaaaaaa4mlehopmvdluv2wjcdp4tnh2ypjz3nhhpahb4ss7yvxaa3be3diq"
-history = NoSQLDBChatMessageHistory(
-    table_name=table_name,
-    session_id=session_id,
-    compartment_id=compartment_id,
-    region="us-ashburn-1",
-    ttl=6
-)
 
-# Create the chat prompt template
-prompt_template = ChatPromptTemplate.from_messages(
-    [
-        ("system", "You are a helpful assistant."),
-        MessagesPlaceholder(variable_name="history"),
-        ("human", "{question}"),
-    ]
-)
+# The model, the chain and the message cache are built once per process and shared by the sessions,
+# a rerun (slider move, new message) only looks them up. Each combination of sliders is a new entry.
+@st.cache_resource(max_entries=8)
+def get_model(llm, temperature, top_p, top_k, max_tokens):
+    return ChatOCIGenAI(
+        model_id=llm ,  
+        service_endpoint="https://inference.generativeai.us-chicago-1.oci.oraclecloud.com",
+        compartment_id=compartment_id,
+        model_kwargs={"temperature": temperature, "max_tokens": max_tokens, "top_p": top_p, "top_k": top_k},
+    )
+
+@st.cache_resource
+def get_message_cache():
+    return MessageCache()
 
-# Combine the prompt with the ChatOCIGenAI LLM
-chain = prompt_template | model | StrOutputParser()
+def get_session_history(session_id):
+    """The history of the Streamlit session, built on its first run on the shared handle"""
+    if 'history' not in st.session_state:
+        st.session_state.history = NoSQLDBChatMessageHistory(
+            table_name=table_name,
+            session_id=session_id,
+            compartment_id=compartment_id,
+            region="us-ashburn-1",
+            ttl=6,
+            message_cache=get_message_cache(),
+            # read the session while the chain is built
+            prefetch=True
+        )
+    return st.session_state.history
 
+@st.cache_resource(max_entries=8)
+def get_chain_with_history(llm, temperature, top_p, top_k, max_tokens):
+    # Create the chat prompt template
+    prompt_template = ChatPromptTemplate.from_messages(
+        [
+            ("system", "You are a helpful assistant."),
+            MessagesPlaceholder(variable_name="history"),
+            ("human", "{question}"),
+        ]
+    )
 
+    # Combine the prompt with the ChatOCIGenAI LLM
+    chain = prompt_template | get_model(llm, temperature, top_p, top_k, max_tokens) | StrOutputParser()
 
-# Integrate with message history
-chain_with_history = RunnableWithMessageHistory(
-    chain,
-    lambda session_id: history,   
-    input_messages_key="question",
-    history_messages_key="history",
-)
+    # Integrate with message history - the history of the session is looked up at invoke time
+    return RunnableWithMessageHistory(
+        chain,
+        get_session_history,
+        input_messages_key="question",
+        history_messages_key="history",
+    )
+
+history = get_session_history(session_id)
+model = get_model(llm, temperature, top_p, top_k, max_tokens)
+chain_with_history = get_chain_with_history(llm, temperature, top_p, top_k, max_tokens)
 
 
 # Load messages from NoSQLDB and populate chat history
@@ -102,26 +123,28 @@ if prompt := st.chat_input("What is up?"):
     st.session_state.messages.append({"role": "user", "content": prompt})
    
     # Generate assistant response using ChatOCIGenAI LLM and LangChain
-    if with_history:
-        config = {"configurable": {"session_id": session_id}}
-        response = chain_with_history.invoke({"question": prompt}, config=config)
+    config = {"configurable": {"session_id": session_id}}
+    if streaming:
+        # Display the tokens in chat message container as they arrive. RunnableWithMessageHistory
+        # stores the question and the whole answer in NoSQLDB once, when the stream ends
+        with st.chat_message("assistant"):
+            if with_history:
+                response = st.write_stream(chain_with_history.stream({"question": prompt}, config=config))
+            else:
+                response = st.write_stream(chunk.content for chunk in model.stream(prompt, temperature=0.7))
     else:
-        response = model.invoke(prompt, temperature=0.7)
-
-    # Display assistant response in chat message container
-    with st.chat_message("assistant"):
         if with_history:
-            st.markdown(response)
+            response = chain_with_history.invoke({"question": prompt}, config=config)
         else:
-            st.markdown(response.content)
+            response = model.invoke(prompt, temperature=0.7).content
+
+        # Display assistant response in chat message container
+        with st.chat_message("assistant"):
+            st.markdown(response)
     # Add assistant response to chat history
-    if with_history:
-        st.session_state.messages.append({"role": "assistant", "content": response})
-    else: 
-        st.session_state.messages.append({"role": "assistant", "content": response.content})
+    st.session_state.messages.append({"role": "assistant", "content": response})
  
-    debug_info = history._debug.replace('\n', '<br><li>')
+    debug_info = "".join(f"<br><li>{line}" for line in history.metrics.summary())
     st.markdown(f"🔍 **🐞 Measurement:**{debug_info}", unsafe_allow_html=True)
-    
-history.close_handle()
+# the history and its shared handle are kept between the reruns, the handles are closed at exit
  
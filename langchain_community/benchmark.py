@@ -0,0 +1,153 @@
+"""Benchmark of NoSQLDBChatMessageHistory on a local stand-in backend.
+
+Measures, for each storage mode, session length and message size, the per-turn latency and CPU time of
+messages and add_messages, the bytes written per turn and the cost of clear. Results can be saved as JSON
+and compared with a previous run to report the regressions.
+
+    python benchmark.py --lengths 10 100 1000 10000 --sizes 200 2000 --json results.json
+    python benchmark.py --baseline results.json --tolerance 0.2
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import sys
+import time
+import uuid
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from NoSQLDBBackend import DOCUMENT_STORAGE, MESSAGE_STORAGE, InMemoryBackend, SQLiteBackend
+from NoSQLDBChatMessageHistory import NoSQLDBChatMessageHistory, MessageCache
+from NoSQLDBMetrics import NoSQLDBMetrics
+
+# metrics compared with the baseline, lower is better
+COMPARED = ("messages_p50_ms", "add_messages_p50_ms", "messages_cpu_ms", "add_messages_cpu_ms", "bytes_written")
+
+
+def _percentile(samples, percent):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, max(0, math.ceil(percent / 100 * len(samples)) - 1))]
+
+
+def _conversation(count, size):
+    """count messages alternating human and AI, of size characters each"""
+    text = ("lorem ipsum dolor sit amet " * (size // 27 + 1))[:size]
+    return [HumanMessage(content=f"{i} {text}") if i % 2 == 0 else AIMessage(content=f"{i} {text}")
+            for i in range(count)]
+
+
+def _timed(samples, func, *args):
+    """Call func, append (wall ms, cpu ms) to samples"""
+    start_time, start_cpu = time.perf_counter(), time.process_time()
+    result = func(*args)
+    samples.append(((time.perf_counter() - start_time) * 1000, (time.process_time() - start_cpu) * 1000))
+    return result
+
+
+def run_case(backend, storage_mode, length, size, turns, history_options):
+    """Fill a session with length messages then run turns (read the history, append a question and an answer)"""
+    metrics = NoSQLDBMetrics()
+    backend.metrics = metrics
+    session_id = str(uuid.uuid4())
+    history = NoSQLDBChatMessageHistory(region=None, table_name="benchmark_" + storage_mode, compartment_id=None,
+                                        session_id=session_id, storage_mode=storage_mode, backend=backend,
+                                        metrics=metrics, **history_options)
+    history.add_messages(_conversation(length, size))
+    metrics.reset()
+
+    reads, writes = [], []
+    for turn in _conversation(2 * turns, size)[::2]:
+        _timed(reads, lambda: history.messages)
+        _timed(writes, history.add_messages, [turn, AIMessage(content=turn.content)])
+    written = sum(stats["write_kb"] for stats in metrics.snapshot()["operations"].values()) * 1024
+    clears = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        _timed(clears, history.clear)
+    history.close_handle()
+
+    return {
+        "storage_mode": storage_mode, "length": length, "size": size, "turns": turns,
+        "messages_p50_ms": _percentile([wall for wall, cpu in reads], 50),
+        "messages_p95_ms": _percentile([wall for wall, cpu in reads], 95),
+        "messages_cpu_ms": sum(cpu for wall, cpu in reads) / turns,
+        "add_messages_p50_ms": _percentile([wall for wall, cpu in writes], 50),
+        "add_messages_p95_ms": _percentile([wall for wall, cpu in writes], 95),
+        "add_messages_cpu_ms": sum(cpu for wall, cpu in writes) / turns,
+        "bytes_written": written / turns,
+        "clear_ms": clears[0][0],
+    }
+
+
+def _key(result):
+    return result["storage_mode"], result["length"], result["size"]
+
+
+def regressions(results, baseline, tolerance):
+    """Lines describing the metrics more than tolerance (fraction) worse than the baseline"""
+    previous = {_key(result): result for result in baseline}
+    lines = []
+    for result in results:
+        before = previous.get(_key(result))
+        if before is None:
+            continue
+        for name in COMPARED:
+            if before.get(name) and result[name] > before[name] * (1 + tolerance):
+                lines.append("{} length={} size={}: {} {:.3f} -> {:.3f} (+{:.0%})".format(
+                    *_key(result), name, before[name], result[name], result[name] / before[name] - 1))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of NoSQLDBChatMessageHistory on a local backend")
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--sqlite-path", default=":memory:")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every round trip")
+    parser.add_argument("--modes", nargs="+", default=[DOCUMENT_STORAGE, MESSAGE_STORAGE])
+    parser.add_argument("--lengths", nargs="+", type=int, default=[10, 100, 1000, 10000])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[200, 2000], help="characters per message")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--encoding", choices=("compact", "zlib"), default=None)
+    parser.add_argument("--max-messages", type=int, default=None)
+    parser.add_argument("--cache", action="store_true", help="use a MessageCache")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before a regression")
+    args = parser.parse_args(argv)
+
+    if args.backend == "sqlite":
+        backend = SQLiteBackend(args.sqlite_path, latency=args.latency)
+    else:
+        backend = InMemoryBackend(latency=args.latency)
+    history_options = dict(payload_encoding=args.encoding, max_messages=args.max_messages,
+                           # single writer, the entries only expire for the message mode that needs a max_age
+                           message_cache=MessageCache(max_age=3600) if args.cache else None)
+
+    print("{:<9} {:>6} {:>6} | {:>9} {:>9} {:>8} | {:>9} {:>9} {:>8} | {:>11} {:>9}".format(
+        "mode", "length", "size", "read p50", "read p95", "read cpu", "add p50", "add p95", "add cpu",
+        "bytes/turn", "clear"))
+    results = []
+    for storage_mode in args.modes:
+        for length in args.lengths:
+            for size in args.sizes:
+                result = run_case(backend, storage_mode, length, size, args.turns, history_options)
+                results.append(result)
+                print("{storage_mode:<9} {length:>6} {size:>6} | {messages_p50_ms:>9.3f} {messages_p95_ms:>9.3f} "
+                      "{messages_cpu_ms:>8.3f} | {add_messages_p50_ms:>9.3f} {add_messages_p95_ms:>9.3f} "
+                      "{add_messages_cpu_ms:>8.3f} | {bytes_written:>11.0f} {clear_ms:>9.3f}".format(**result))
+    backend.close()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as file:
+            lines = regressions(results, json.load(file), args.tolerance)
+        print("\n".join(["Regressions:"] + lines) if lines else "No regression")
+        return 1 if lines else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
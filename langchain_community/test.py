@@ -14,12 +14,25 @@ top_p = 0.95
 top_k = 50
 max_tokens = 100
 with_history = True
+# answer the repeated questions from the NoSQLDBCache instead of calling the model
+use_cache = False
+
+from NoSQLDBCache import NoSQLDBCache
+llm_cache = None
+if use_cache:
+    llm_cache = NoSQLDBCache(
+        table_name="LLMCache",
+        compartment_id="ocid1.compartment.oc1..aaaaaaaa4mlehopmvdluv2wjcdp4tnh2ypjz3nhhpahb4ss7yvxaa3be3diq",
+        region="us-ashburn-1",
+        ttl=24
+    )
 
 model = ChatOCIGenAI(
     model_id=llm ,  
     service_endpoint="https://inference.generativeai.us-chicago-1.oci.oraclecloud.com",
     compartment_id="ocid1.compartment.oc1..aaaaaaaa4mlehopmvdluv2wjcdp4tnh2ypjz3nhhpahb4ss7yvxaa3be3diq",
     model_kwargs={"temperature": temperature, "max_tokens": max_tokens, "top_p": top_p, "top_k": top_k},
+    cache=llm_cache,
 )
 
 ## Initialize the NoSQLDB chat message history
@@ -74,7 +87,7 @@ while True:
     #   print(response)
     #else:
     #   print(response.content)
-    print(history._debug)
+    print("\n".join(history.metrics.summary()))
  
 history.close_handle()
  
@@ -0,0 +1,230 @@
+"""Tests of NoSQLDBChatMessageHistory on the InMemoryBackend stand-in - no network nor credentials.
+
+    pip install pytest
+    python -m pytest -q test_NoSQLDBChatMessageHistory.py
+"""
+import threading
+import time
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+from NoSQLDBBackend import DOCUMENT_STORAGE, MESSAGE_STORAGE, ChatHistoryBackend, InMemoryBackend, SQLiteBackend
+from NoSQLDBChatMessageHistory import (ABSOLUTE_EXPIRY, COMPACT_ENCODING, MESSAGE_EXPIRY, SUMMARY_KWARG,
+                                       ZLIB_ENCODING, ExpiryPolicy, MessageCache, NoSQLDBChatMessageHistory,
+                                       TTL_REFRESH_INTERVAL, truncating_summarizer)
+from NoSQLDBMetrics import NoSQLDBMetrics
+
+STORAGE_MODES = (DOCUMENT_STORAGE, MESSAGE_STORAGE)
+HOUR = 3600
+
+
+class Clock:
+    """Time of the backend, moved forward by the tests"""
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def backend(clock):
+    return InMemoryBackend(clock=clock, metrics=NoSQLDBMetrics())
+
+
+def history(backend, storage_mode, session_id="session", **options):
+    return NoSQLDBChatMessageHistory(region=None, table_name="history_" + storage_mode, compartment_id=None,
+                                     session_id=session_id, storage_mode=storage_mode, backend=backend,
+                                     metrics=backend.metrics, **options)
+
+
+def conversation(count, start=0):
+    return [HumanMessage(content=f"question {i}") if i % 2 == 0 else AIMessage(content=f"answer {i}")
+            for i in range(start, start + count)]
+
+
+@pytest.mark.parametrize("storage_mode", STORAGE_MODES)
+@pytest.mark.parametrize("payload_encoding", (None, COMPACT_ENCODING, ZLIB_ENCODING))
+def test_round_trip(backend, storage_mode, payload_encoding):
+    messages = conversation(6) + [ToolMessage(content="result", tool_call_id="call", artifact=[]),
+                                  AIMessage(content="", tool_calls=[{"name": "tool", "args": {"a": 1}, "id": "call"}])]
+    writer = history(backend, storage_mode, payload_encoding=payload_encoding, compress_threshold=0)
+    writer.add_messages(messages[:3])
+    writer.add_messages(messages[3:])
+    assert history(backend, storage_mode).messages == messages
+    writer.clear()
+    assert history(backend, storage_mode).messages == []
+
+
+@pytest.mark.parametrize("storage_mode", STORAGE_MODES)
+def test_message_cache_follows_other_writers(backend, storage_mode):
+    cache = MessageCache(max_age=60)
+    cached = history(backend, storage_mode, message_cache=cache)
+    cached.add_messages(conversation(2))
+    history(backend, storage_mode).add_messages(conversation(2, start=2))
+    # the conditional put of the stale cached session fails, the session is reloaded
+    cached.add_messages(conversation(2, start=4))
+    assert history(backend, storage_mode).messages == conversation(6)
+
+
+def test_message_cache_after_a_clear_by_another_writer(backend):
+    with pytest.raises(ValueError):
+        history(backend, MESSAGE_STORAGE, message_cache=MessageCache())
+    cached = history(backend, MESSAGE_STORAGE, message_cache=MessageCache(max_age=0.2))
+    cached.add_messages(conversation(2))
+    assert cached.messages == conversation(2)
+    history(backend, MESSAGE_STORAGE).clear()
+    time.sleep(0.15)
+    # the put of the next sequence succeeds on the cleared session, the append does not renew the stale entry
+    cached.add_messages(conversation(1, start=2))
+    time.sleep(0.15)
+    assert cached.messages == conversation(1, start=2)
+
+
+@pytest.mark.parametrize("storage_mode", STORAGE_MODES)
+def test_concurrent_appends_lose_no_message(storage_mode):
+    # a little latency between the read and the conditional put makes the writers conflict
+    backend = InMemoryBackend(latency=0.001, metrics=NoSQLDBMetrics())
+    writers, turns = 4, 10
+    errors = []
+
+    def write(writer):
+        try:
+            for turn in range(turns):
+                history(backend, storage_mode).add_messages([HumanMessage(content=f"{writer}-{turn}")])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    contents = [message.content for message in history(backend, storage_mode).messages]
+    assert sorted(contents) == sorted(f"{writer}-{turn}" for writer in range(writers) for turn in range(turns))
+    for writer in range(writers):
+        # the appends of one writer keep their order
+        own = [content for content in contents if content.startswith(f"{writer}-")]
+        assert own == [f"{writer}-{turn}" for turn in range(turns)]
+
+
+def test_appends_after_a_clear_keep_their_order(backend):
+    cleared = history(backend, MESSAGE_STORAGE)
+    other = history(backend, MESSAGE_STORAGE)
+    other.add_messages(conversation(2))
+    cleared.add_messages([HumanMessage(content="a")])
+    cleared.clear()
+    # the other writer still knows the next sequence of the session before the clear
+    other.add_messages([HumanMessage(content="b-after-clear")])
+    cleared.add_messages([HumanMessage(content="a-after-b")])
+    contents = [message.content for message in history(backend, MESSAGE_STORAGE).messages]
+    assert contents == ["b-after-clear", "a-after-b"]
+
+
+@pytest.mark.parametrize("storage_mode", STORAGE_MODES)
+def test_window_returns_the_tail(backend, storage_mode):
+    history(backend, storage_mode).add_messages(conversation(30))
+    assert history(backend, storage_mode, max_messages=4).messages == conversation(30)[-4:]
+    assert history(backend, storage_mode, max_messages=0).messages == []
+    # one token per message with this counter
+    tail = history(backend, storage_mode, max_tokens=5, token_counter=lambda message: 1).messages
+    assert tail == conversation(30)[-5:]
+    both = history(backend, storage_mode, max_messages=10, max_tokens=3, token_counter=lambda message: 1).messages
+    assert both == conversation(30)[-3:]
+
+
+@pytest.mark.parametrize("storage_mode", STORAGE_MODES)
+def test_compaction_keeps_a_summary_and_the_tail(backend, storage_mode):
+    options = dict(summarizer=truncating_summarizer, compaction_threshold=10, compaction_keep=4)
+    writer = history(backend, storage_mode, **options)
+    for turn in range(8):
+        writer.add_messages(conversation(2, start=2 * turn))
+    messages = history(backend, storage_mode).messages
+    assert len(messages) <= 11
+    summary = messages[0]
+    assert isinstance(summary, SystemMessage) and summary.additional_kwargs[SUMMARY_KWARG]
+    assert "question 0" in summary.content
+    assert messages[-4:] == conversation(16)[-4:]
+
+
+@pytest.mark.parametrize("storage_mode", STORAGE_MODES)
+def test_empty_append_with_compaction(backend, storage_mode):
+    options = dict(summarizer=truncating_summarizer, compaction_threshold=10, compaction_keep=4)
+    history(backend, storage_mode, **options).add_messages([])
+    writer = history(backend, storage_mode, **options)
+    writer.add_messages(conversation(2))
+    writer.add_messages([])
+    assert history(backend, storage_mode).messages == conversation(2)
+
+
+@pytest.mark.parametrize("storage_mode", STORAGE_MODES)
+def test_sliding_expiry(backend, clock, storage_mode):
+    expiry = ExpiryPolicy(2)
+    history(backend, storage_mode, session_id="sliding", expiry=expiry).add_messages(conversation(2))
+    clock.now += 1.5 * HOUR
+    history(backend, storage_mode, session_id="sliding", expiry=expiry).add_messages(conversation(2, start=2))
+    # 3 hours after the first write, 1.5 hours after the last one
+    clock.now += 1.5 * HOUR
+    assert history(backend, storage_mode, session_id="sliding").messages == conversation(4)
+    # the refreshed rows may outlive the TTL by TTL_REFRESH_INTERVAL, not more
+    clock.now += 1 * HOUR + TTL_REFRESH_INTERVAL
+    assert history(backend, storage_mode, session_id="sliding").messages == []
+
+
+def test_sliding_expiry_between_refreshes(backend, clock):
+    start = clock.now
+    expiry = ExpiryPolicy(1)
+    # the append at 0.5 hour comes before the next refresh of the TTL of the older rows
+    for content, at in (("m0", 0), ("m1", 0.5), ("m2", 1.2)):
+        clock.now = start + at * HOUR
+        history(backend, MESSAGE_STORAGE, session_id="between", expiry=expiry).add_messages(
+            [HumanMessage(content=content)])
+    # 0.4 hour after the last append, the whole session is alive
+    clock.now = start + 1.6 * HOUR
+    contents = [message.content for message in history(backend, MESSAGE_STORAGE, session_id="between").messages]
+    assert contents == ["m0", "m1", "m2"]
+
+
+@pytest.mark.parametrize("storage_mode", STORAGE_MODES)
+def test_absolute_expiry(backend, clock, storage_mode):
+    expiry = ExpiryPolicy(2, mode=ABSOLUTE_EXPIRY)
+    history(backend, storage_mode, session_id="absolute", expiry=expiry).add_messages(conversation(2))
+    clock.now += 1.5 * HOUR
+    history(backend, storage_mode, session_id="absolute", expiry=expiry).add_messages(conversation(2, start=2))
+    assert history(backend, storage_mode, session_id="absolute").messages == conversation(4)
+    # the message mode gives the new rows the remaining time rounded up to the hour, like the service
+    clock.now += 1.6 * HOUR
+    assert history(backend, storage_mode, session_id="absolute").messages == []
+
+
+def test_message_expiry(backend, clock):
+    expiry = ExpiryPolicy(2, mode=MESSAGE_EXPIRY)
+    history(backend, MESSAGE_STORAGE, session_id="message", expiry=expiry).add_messages(conversation(2))
+    clock.now += 1.5 * HOUR
+    history(backend, MESSAGE_STORAGE, session_id="message", expiry=expiry).add_messages(conversation(2, start=2))
+    clock.now += 1 * HOUR
+    # the oldest messages expired on their own
+    assert history(backend, MESSAGE_STORAGE, session_id="message").messages == conversation(2, start=2)
+
+
+def test_message_expiry_needs_message_storage(backend):
+    with pytest.raises(ValueError):
+        history(backend, DOCUMENT_STORAGE, expiry=ExpiryPolicy(2, mode=MESSAGE_EXPIRY))
+
+
+def test_backends_implement_the_interface():
+    class DocumentOnly(ChatHistoryBackend):
+        def get_document(self, table, session_id):
+            return None, None
+
+    with pytest.raises(TypeError):
+        DocumentOnly()
+    InMemoryBackend()
+    SQLiteBackend().close()
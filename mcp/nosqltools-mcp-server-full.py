@@ -17,12 +17,21 @@ For questions, consult your legal, security, or compliance team.
 """
 
 import os.path
+import asyncio
+import functools
 import json
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import oci
 from oci.resource_search.models import StructuredSearchDetails
 
-from borneo import (Regions, NoSQLHandle, NoSQLHandleConfig, QueryRequest, QueryIterableResult , ListTablesRequest, GetTableRequest, TableLimits )
+from borneo import (Regions, NoSQLHandle, NoSQLHandleConfig, QueryRequest, QueryIterableResult , ListTablesRequest, GetTableRequest, TableLimits, PrepareRequest,
+                    IllegalArgumentException, TableNotFoundException )
 from borneo.iam import SignatureProvider
 
 from fastmcp import FastMCP
@@ -43,6 +52,187 @@ provider = SignatureProvider(profile_name=profile_name);
 configN = NoSQLHandleConfig(config['region'], provider).set_logger(None)
 handle = NoSQLHandle(configN)
 
+# Compartment name -> compartment index, rebuilt after COMPARTMENT_CACHE_TTL seconds
+# or on a miss, but not more than once every COMPARTMENT_MISS_INTERVAL seconds
+COMPARTMENT_CACHE_TTL = int(os.getenv("COMPARTMENT_CACHE_TTL", "300"))
+COMPARTMENT_MISS_INTERVAL = 30
+compartments_by_name = None
+compartments_loaded = 0.0
+compartments_lock = threading.Lock()
+
+# The tools are async, their blocking OCI SDK and Borneo calls run on a pool of SDK_MAX_WORKERS threads
+# and each tool runs at most TOOL_CONCURRENCY calls at once, the others wait without blocking the event loop
+SDK_MAX_WORKERS = int(os.getenv("SDK_MAX_WORKERS", "16"))
+TOOL_CONCURRENCY = int(os.getenv("TOOL_CONCURRENCY", "4"))
+sdk_executor = ThreadPoolExecutor(max_workers=SDK_MAX_WORKERS, thread_name_prefix="nosql-mcp")
+
+# Paged queries - execute_query_borneo returns at most QUERY_MAX_ROWS rows and QUERY_MAX_BYTES bytes of JSON per call.
+# The QueryRequest of an unfinished query (it holds the borneo continuation key and the state of sorting or
+# grouping queries) is kept under an opaque next_page token for QUERY_CURSOR_TTL seconds, QUERY_MAX_CURSORS at most
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "500"))
+QUERY_MAX_BYTES = int(os.getenv("QUERY_MAX_BYTES", "200000"))
+QUERY_CURSOR_TTL = 600
+QUERY_MAX_CURSORS = 100
+query_cursors = OrderedDict()  # token -> (compartment_name, statement, bind variables, QueryRequest, pending rows, expires)
+query_cursors_lock = threading.Lock()
+
+# Prepared statements of the query tools, LRU of PREPARED_CACHE_SIZE entries keyed by (endpoint, compartment, statement).
+# The entries of a table are dropped when describe_nosql_table(_borneo) sees a new DDL for it
+PREPARED_CACHE_SIZE = int(os.getenv("PREPARED_CACHE_SIZE", "200"))
+prepared_statements = OrderedDict()
+prepared_statements_lock = threading.Lock()
+table_ddls = {}  # (compartment, table name) -> last DDL seen
+# errors of a query whose prepared statement may be stale (table dropped or altered), it is then prepared again once
+STALE_PREPARED_ERRORS = (IllegalArgumentException, TableNotFoundException)
+STALE_PREPARED_STATUSES = (400, 404)
+# quoted strings, kept as is by normalize_statement
+QUOTED = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")")
+
+# Results of execute_query_borneo, opt-in: kept QUERY_CACHE_TTL seconds (0: no cache) in an LRU of QUERY_CACHE_MAX_BYTES.
+# Only complete (not truncated) results of read queries without row or time functions are cached,
+# a write through the tools or a new DDL of a table drops the entries
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "0"))
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", "10000000"))
+query_results = OrderedDict()  # (compartment, statement, bind variables, max_rows, max_bytes) -> (response, expires)
+query_results_bytes = 0
+query_results_lock = threading.Lock()
+UNCACHEABLE = re.compile(r"\b(insert|upsert|update|delete|modification_time|expiration_time|expiration_time_millis|"
+                         r"creation_time|creation_time_millis|remaining_hours|remaining_days|row_storage_size|"
+                         r"partition|shard|current_time|current_time_millis)\b", re.IGNORECASE)
+WRITES = re.compile(r"\b(insert|upsert|update|delete)\b", re.IGNORECASE)
+
+
+def save_query_cursor(query: tuple, request, pending: list) -> str:
+    """Internal function to keep an unfinished query (compartment_name, statement, bind variables), return its next_page token"""
+    token = secrets.token_urlsafe(16)
+    with query_cursors_lock:
+        query_cursors[token] = query + (request, pending, time.monotonic() + QUERY_CURSOR_TTL)
+        while len(query_cursors) > QUERY_MAX_CURSORS:
+            query_cursors.popitem(last=False)
+    return token
+
+def take_query_cursor(token: str):
+    """Internal function to get and forget the query of a next_page token, None when unknown or expired"""
+    with query_cursors_lock:
+        cursor = query_cursors.pop(token, None)
+    if cursor is None or cursor[5] < time.monotonic():
+        return None
+    return cursor
+
+def normalize_statement(statement: str) -> str:
+    """Internal function - the statement with its whitespace outside quoted strings collapsed"""
+    parts = QUOTED.split(statement.strip())
+    # odd parts are the quoted strings
+    return "".join(part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts))
+
+def get_prepared_statement(endpoint: str, compartment: str, statement: str, prepare):
+    """Internal function to get a prepared statement from the LRU cache, calling prepare(statement) on a miss"""
+    key = (endpoint, compartment, normalize_statement(statement))
+    with prepared_statements_lock:
+        prepared = prepared_statements.get(key)
+        if prepared is not None:
+            prepared_statements.move_to_end(key)
+            return prepared
+    prepared = prepare(statement)
+    with prepared_statements_lock:
+        prepared_statements[key] = prepared
+        while len(prepared_statements) > PREPARED_CACHE_SIZE:
+            prepared_statements.popitem(last=False)
+    return prepared
+
+def invalidate_prepared_statements(table_name: str = None, statement: str = None) -> None:
+    """Internal function to forget the prepared statements using the table, or of the statement"""
+    table = re.compile(r'(?<![\w.])' + re.escape(table_name) + r'(?![\w.])', re.IGNORECASE) if table_name else None
+    statement = normalize_statement(statement) if statement else None
+    with prepared_statements_lock:
+        for key in list(prepared_statements):
+            if (table is not None and table.search(key[2])) or (statement is not None and key[2] == statement):
+                del prepared_statements[key]
+
+def table_ddl_seen(compartment: str, table_name: str, ddl: str) -> None:
+    """Internal function to record the DDL of a table, the prepared statements using it are dropped when it changed"""
+    key = (compartment, table_name.lower())
+    previous = table_ddls.get(key)
+    table_ddls[key] = ddl
+    if previous is not None and previous != ddl:
+        invalidate_prepared_statements(table_name)
+        invalidate_query_results(table_name)
+
+def statement_code(statement: str) -> str:
+    """Internal function - the statement without its quoted strings"""
+    return " ".join(QUOTED.split(statement)[::2])
+
+def get_query_result(key: tuple):
+    """Internal function to get a cached response, None when absent or expired"""
+    global query_results_bytes
+    with query_results_lock:
+        entry = query_results.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del query_results[key]
+            query_results_bytes -= len(entry[0])
+            return None
+        query_results.move_to_end(key)
+        return entry[0]
+
+def put_query_result(key: tuple, response: str) -> None:
+    """Internal function to cache a response, evicting the least recently used ones beyond QUERY_CACHE_MAX_BYTES"""
+    global query_results_bytes
+    if len(response) > QUERY_CACHE_MAX_BYTES:
+        return
+    with query_results_lock:
+        previous = query_results.pop(key, None)
+        if previous is not None:
+            query_results_bytes -= len(previous[0])
+        query_results[key] = (response, time.monotonic() + QUERY_CACHE_TTL)
+        query_results_bytes += len(response)
+        while query_results_bytes > QUERY_CACHE_MAX_BYTES:
+            evicted = query_results.popitem(last=False)[1]
+            query_results_bytes -= len(evicted[0])
+
+def invalidate_query_results(table_name: str = None) -> None:
+    """Internal function to forget the cached responses of the queries using the table, all of them by default"""
+    global query_results_bytes
+    table = re.compile(r'(?<![\w.])' + re.escape(table_name) + r'(?![\w.])', re.IGNORECASE) if table_name else None
+    with query_results_lock:
+        for key in list(query_results):
+            if table is None or table.search(key[1]):
+                query_results_bytes -= len(query_results.pop(key)[0])
+
+def bind_variable_name(name: str) -> str:
+    """Internal function - the external variable name with its leading $"""
+    return name if name.startswith("$") else "$" + name
+
+def prepare_borneo(compartment_name: str, statement: str):
+    """Internal function to prepare a statement with Borneo"""
+    request = PrepareRequest().set_statement(statement).set_compartment(compartment_name)
+    return handle.prepare(request).get_prepared_statement()
+
+def new_query_request_borneo(compartment_name: str, statement: str, bind_variables: dict):
+    """Internal function to build the QueryRequest of the cached prepared statement with its bind variables"""
+    prepared = get_prepared_statement("borneo", compartment_name, statement,
+                                      lambda statement: prepare_borneo(compartment_name, statement))
+    # the cached statement is shared, the copy carries the variables of this query
+    bound = prepared.copy_statement()
+    for name, value in (bind_variables or {}).items():
+        bound.set_variable(bind_variable_name(name), value)
+    return QueryRequest().set_prepared_statement(bound).set_compartment(compartment_name)
+
+
+def offloaded(max_concurrency: int = None):
+    """Internal decorator turning a blocking tool into an async one running on sdk_executor,
+    at most max_concurrency (TOOL_CONCURRENCY) calls at once"""
+    def decorator(func):
+        semaphore = asyncio.Semaphore(max_concurrency or TOOL_CONCURRENCY)
+        @functools.wraps(func)
+        async def tool(*args, **kwargs):
+            async with semaphore:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(sdk_executor, functools.partial(func, *args, **kwargs))
+        return tool
+    return decorator
+
 
 # Using OCI SDK
 
@@ -72,15 +262,36 @@ def list_all_compartments_internal(only_one_page: bool , limit = 100  ):
     
     return compartments
 
+def compartment_index_is_fresh(stale_before: float = None) -> bool:
+    """Internal function - True when the compartment index is loaded, within its TTL and newer than stale_before"""
+    if compartments_by_name is None or time.monotonic() - compartments_loaded > COMPARTMENT_CACHE_TTL:
+        return False
+    return stale_before is None or compartments_loaded > stale_before
+
+def get_compartment_index(stale_before: float = None):
+    """Internal function to get the case-insensitive name -> compartment index and its load time.
+    Concurrent callers wait for a single rebuild"""
+    global compartments_by_name, compartments_loaded
+    if compartment_index_is_fresh(stale_before):
+        return compartments_by_name, compartments_loaded
+    with compartments_lock:
+        if not compartment_index_is_fresh(stale_before):
+            index = {}
+            for compartment in list_all_compartments_internal(False):
+                # same name at different levels of the hierarchy - the first one listed wins
+                index.setdefault(compartment.name.lower(), compartment)
+            compartments_by_name, compartments_loaded = index, time.monotonic()
+        return compartments_by_name, compartments_loaded
+
 def get_compartment_by_name(compartment_name: str):
     """Internal function to get compartment by name with caching"""
-    compartments = list_all_compartments_internal(False)
-    # Search for the compartment by name
-    for compartment in compartments:
-        if compartment.name.lower() == compartment_name.lower():
-            return compartment
-
-    return None
+    index, loaded = get_compartment_index()
+    compartment = index.get(compartment_name.lower())
+    if compartment is None and time.monotonic() - loaded > COMPARTMENT_MISS_INTERVAL:
+        # the compartment may have been created since the index was built
+        index, loaded = get_compartment_index(loaded)
+        compartment = index.get(compartment_name.lower())
+    return compartment
 
 def get_compartment_by_name_v2(compartment_name: str):
     """Internal function to get compartment by name using the query API"""
@@ -104,6 +315,7 @@ def get_compartment_by_name_v2(compartment_name: str):
         return None
 
 @mcp.tool()
+@offloaded()
 def list_all_compartments() -> str:
     """List all compartments in a tenancy with clear formatting"""
     compartments= list_all_compartments_internal(True)
@@ -111,6 +323,7 @@ def list_all_compartments() -> str:
     return json.dumps(filtered)
 
 @mcp.tool()
+@offloaded()
 def get_compartment_by_name_tool(name: str) -> str:
     """Return a compartment matching the provided name"""
     compartment = get_compartment_by_name(name)
@@ -121,6 +334,7 @@ def get_compartment_by_name_tool(name: str) -> str:
         return str({"error": f"Compartment '{name}' not found."})
 
 @mcp.tool()
+@offloaded()
 def list_nosql_tables(compartment_name: str) -> str:
     """List all tables in a given compartment name"""
     compartment = get_compartment_by_name_v2(compartment_name)
@@ -135,6 +349,7 @@ def list_nosql_tables(compartment_name: str) -> str:
     return str(tables)
 
 @mcp.tool()
+@offloaded()
 def describe_nosql_table(compartment_name: str, table_name: str ) -> str:
     """describe a NoSQL table in a given compartment name"""
     compartment = get_compartment_by_name(compartment_name)
@@ -142,6 +357,7 @@ def describe_nosql_table(compartment_name: str, table_name: str ) -> str:
         return json.dumps({"error": f"Compartment '{compartment_name}' not found. Use list_compartment_names() to see available compartments."})
     
     nosql_info = nosql_client.get_table(table_name_or_id=table_name, compartment_id=compartment.id).data
+    table_ddl_seen(compartment.id, table_name, nosql_info.ddl_statement)
     return str(nosql_info)
 
 """
@@ -150,7 +366,8 @@ This function may interact with large language models (LLMs). Review the full di
 Never send production, sensitive, or regulated data to LLMs without explicit organizational approval. See your privacy and security team for details.
 """
 @mcp.tool()
-def execute_query(compartment_name: str, sql_script: str) -> str:
+@offloaded()
+def execute_query(compartment_name: str, sql_script: str, bind_variables: dict = None) -> str:
     """Execute a SQL query in Oracle NoSQL database using standard endpoint.
     
     USAGE GUIDELINES:
@@ -162,35 +379,57 @@ def execute_query(compartment_name: str, sql_script: str) -> str:
     - for LIKE expresions use regex_like expressions
     - Oracle NoSQL supports Function on Rows including modification_time and expiration_time (more https://docs.oracle.com/en/database/other-databases/nosql-database/25.1/sqlreferencefornosql/functions-rows.html)
     - Always CAST timestamp functions to STRING: modification_time(t),expirationtime(t) due to JSON serialization
+    - Prefer bind variables to literal values for queries run more than once, the statement is prepared once
     
     Example:
     SELECT /*  AI Tool: Claude - Query*/ * FROM users $t    
     SELECT /*  AI Tool: GPT-4 - Query*/ * FROM users $t    
+    DECLARE $id INTEGER; SELECT /*  AI Tool: Claude - Query*/ * FROM users $t WHERE $t.id = $id    with bind_variables {"$id": 42}
     
     Args:
         compartment_name: The compartment name to query
         sql_script: The SQL script to execute
+        bind_variables: Optional values of the variables declared by the script, e.g. {"$id": 42}
     """
     compartment = get_compartment_by_name(compartment_name)
     if not compartment:
         return json.dumps({"error": f"Compartment '{compartment_name}' not found. Use list_compartment_names() to see available compartments."})
  
-    query_details=oci.nosql.models.QueryDetails(
-        compartment_id=compartment.id,
-        statement=sql_script,
-        is_prepared=False,
-    )
-    response = nosql_client.query(query_details)
+    query_details = new_query_details(compartment.id, sql_script, bind_variables)
+    try:
+        response = nosql_client.query(query_details)
+    except oci.exceptions.ServiceError as e:
+        if e.status not in STALE_PREPARED_STATUSES:
+            raise
+        # the table may have changed since the statement was prepared - prepare it again, once
+        invalidate_prepared_statements(statement=sql_script)
+        query_details = new_query_details(compartment.id, sql_script, bind_variables)
+        response = nosql_client.query(query_details)
     rows = response.data
     while response.has_next_page:
         response = nosql_client.query(query_details, page = response.next_page)
         rows.extend(response.data)
+    if WRITES.search(statement_code(sql_script)):
+        invalidate_query_results()
     
     return str(rows)
 
+def new_query_details(compartment_id: str, statement: str, bind_variables: dict):
+    """Internal function to build the QueryDetails of the cached prepared statement with its bind variables"""
+    prepared = get_prepared_statement("oci", compartment_id, statement,
+                                      lambda statement: nosql_client.prepare_statement(compartment_id=compartment_id,
+                                                                                       statement=statement).data.statement)
+    return oci.nosql.models.QueryDetails(
+        compartment_id=compartment_id,
+        statement=prepared,
+        is_prepared=True,
+        variables={bind_variable_name(name): value for name, value in (bind_variables or {}).items()} or None,
+    )
+
 # Using NoSQL SDK Borneo
 
 @mcp.tool()
+@offloaded()
 def list_nosql_tables_borneo(compartment_name: str) -> str:
     """List all tables in a given compartment using Borneo endpoint.
     
@@ -207,6 +446,7 @@ def list_nosql_tables_borneo(compartment_name: str) -> str:
 
 
 @mcp.tool()
+@offloaded()
 def describe_nosql_table_borneo(compartment_name: str, table_name: str ) -> str:
     """Describe a NoSQL table structure using Borneo endpoint.
     
@@ -218,6 +458,7 @@ def describe_nosql_table_borneo(compartment_name: str, table_name: str ) -> str:
     """
     gtr = GetTableRequest().set_table_name(table_name).set_compartment(compartment_name)
     gr_result = handle.get_table(gtr)
+    table_ddl_seen(compartment_name, table_name, gr_result.get_ddl())
     limits = None if not gr_result.get_table_limits() else dict(
                             {
                               "capacity_mode": gr_result.get_table_limits().get_mode(),  # TableLimits.CAPACITY_MODE
@@ -261,7 +502,9 @@ This function may interact with large language models (LLMs). Review the full di
 Never send production, sensitive, or regulated data to LLMs without explicit organizational approval. See your privacy and security team for details.
 """
 @mcp.tool()
-def execute_query_borneo(compartment_name: str, sql_script: str) -> str:
+@offloaded()
+def execute_query_borneo(compartment_name: str, sql_script: str, bind_variables: dict = None, next_page: str = None,
+                         max_rows: int = QUERY_MAX_ROWS, max_bytes: int = QUERY_MAX_BYTES, use_cache: bool = True) -> str:
     """execute a SQL query in a given compartment name
        
     IMPORTANT SQL QUERY REQUIREMENTS:
@@ -380,12 +623,52 @@ def execute_query_borneo(compartment_name: str, sql_script: str) -> str:
     
   
     
+    8. LARGE RESULTS (Paging)
+       - A call returns at most max_rows rows and max_bytes bytes of JSON
+       - When "truncated" is true, call again with the same compartment_name and sql_script
+         and next_page set to the returned "next_page" value to get the next rows
+       - Prefer a WHERE clause or a LIMIT to paging through a whole table
+    
+    9. BIND VARIABLES (Repeated queries)
+       - Statements are prepared once and cached, prefer variables to literal values
+       - Declare the variables and pass their values in bind_variables
+       - Example: DECLARE $id INTEGER; SELECT /* AI Tool: Claude - Query */ * FROM users $t WHERE $t.id = $id
+         with bind_variables {"$id": 42}
+    
+    10. RESULT CACHE (When enabled on the server)
+       - "cache_hit": true means the result was returned from a recent identical query, with its original usage
+       - Set use_cache to false to read the current data
+    
     Args:
         compartment_name: The compartment name to query
         sql_script: The SQL script to execute
+        bind_variables: Optional values of the variables declared by the script, e.g. {"$id": 42}
+        next_page: Optional "next_page" value returned by the previous call of the same query
+        max_rows: Maximum number of rows returned by this call
+        max_bytes: Maximum size in bytes of the JSON rows returned by this call
+        use_cache: Return the result of a recent identical query when the result cache is enabled
     """
     
-    request = QueryRequest().set_statement(sql_script).set_compartment(compartment_name) ## compartment.id
+    query = (compartment_name, sql_script, json.dumps(bind_variables or {}, sort_keys=True, default=str))
+    max_rows = max(1, min(max_rows, QUERY_MAX_ROWS))
+    max_bytes = max(1, min(max_bytes, QUERY_MAX_BYTES))
+    code = statement_code(sql_script)
+    # the result cache first, a hit needs neither the prepared statement nor a request
+    cache_key = None
+    if QUERY_CACHE_TTL > 0 and not next_page and not UNCACHEABLE.search(code):
+        cache_key = (compartment_name, normalize_statement(sql_script), query[2], max_rows, max_bytes)
+        if use_cache:
+            cached = get_query_result(cache_key)
+            if cached is not None:
+                return cached
+    if next_page:
+        cursor = take_query_cursor(next_page)
+        if cursor is None or cursor[:3] != query:
+            return json.dumps({"error": "next_page is unknown or expired, run the query again without next_page."})
+        request, pending = cursor[3], cursor[4]
+    else:
+        request = new_query_request_borneo(compartment_name, sql_script, bind_variables)
+        pending = []
     #rows = []
     #ru = 0
     #wu = 0
@@ -397,21 +680,46 @@ def execute_query_borneo(compartment_name: str, sql_script: str) -> str:
     #usageIt = {"read_units_consumed":qiresult.get_read_units(), "write_units_consumed":qiresult.get_write_units()} 
     #usageIt2 = {"read_units_consumed":ru, "write_units_consumed":wu} 
     rows = []
+    size = 0
+    # a new QueryRequest reports is_done() until its first round trip
+    started = bool(next_page)
     ru = 0
     wu = 0
+    # the rows left over by the previous call first, then the next batches until a budget is reached
     while True:
-        result = handle.query(request)
-        results = result.get_results()
+        while pending and len(rows) < max_rows:
+            row_size = len(json.dumps(pending[0])) + 2
+            if rows and size + row_size > max_bytes:
+                break
+            rows.append(pending.pop(0))
+            size += row_size
+        if pending or len(rows) >= max_rows or size >= max_bytes or (started and request.is_done()):
+            break
+        request.set_limit(max_rows - len(rows))
+        try:
+            result = handle.query(request)
+        except STALE_PREPARED_ERRORS:
+            if started:
+                raise
+            # the table may have changed since the statement was prepared - prepare it again, once
+            invalidate_prepared_statements(statement=sql_script)
+            request = new_query_request_borneo(compartment_name, sql_script, bind_variables)
+            request.set_limit(max_rows - len(rows))
+            result = handle.query(request)
+        started = True
+        pending = list(result.get_results())
         ru += result.get_read_units()
         wu += result.get_write_units()
-        for row in results:
-            rows.append(row)
-        if request.is_done():
-            break
     usagePt = {"read_units_consumed":ru, "write_units_consumed":wu} 
     
+    truncated = bool(pending) or not request.is_done()
+    token = save_query_cursor(query, request, pending) if truncated else None
+    if WRITES.search(code):
+        invalidate_query_results()
+    elif cache_key is not None and not truncated:
+        put_query_result(cache_key, json.dumps({"items":rows, "usage":usagePt, "truncated":False, "next_page":None, "cache_hit":True}))
     #return json.dumps({"items":rows, "usage":usageIt, "usage2":usageIt2})
-    return json.dumps({"items":rows, "usage":usagePt})
+    return json.dumps({"items":rows, "usage":usagePt, "truncated":truncated, "next_page":token, "cache_hit":False})
 
 
 if __name__ == "__main__":